@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import json
+import time
+import logging
+import sqlite3
+import struct
+
+from .database import LDAPDatabase, LDAPRecord
+
+logger = logging.getLogger('ldap-expire-notify')
+
+# Entries are stored as: number of attributes, then for every attribute its name length,
+# its number of values and its name, followed by every value length and value
+_COUNT = struct.Struct('>H')
+_ATTR = struct.Struct('>HH')
+_VALUE = struct.Struct('>I')
+
+
+def search_signature(base_dn, query, attrs, scope):
+    # Cached entries are only valid for the same search
+    return json.dumps([base_dn, query, sorted(attrs), scope])
+
+
+def encode_entry(entry):
+    parts = [_COUNT.pack(len(entry))]
+    for attr, values in entry.items():
+        name = attr.encode('utf-8')
+        parts.append(_ATTR.pack(len(name), len(values)))
+        parts.append(name)
+        for value in values:
+            parts.append(_VALUE.pack(len(value)))
+            parts.append(value)
+    return b''.join(parts)
+
+
+def decode_entry(buf, offset=0):
+    """Decodes an entry encoded by `encode_entry` from `buf` (any buffer) at `offset`,
+    returns the entry and the offset where it ends"""
+    entry = {}
+    count, = _COUNT.unpack_from(buf, offset)
+    offset += _COUNT.size
+    for _ in range(count):
+        name_length, num_values = _ATTR.unpack_from(buf, offset)
+        offset += _ATTR.size
+        name = bytes(buf[offset:offset + name_length]).decode('utf-8')
+        offset += name_length
+        values = []
+        for _ in range(num_values):
+            length, = _VALUE.unpack_from(buf, offset)
+            offset += _VALUE.size
+            values.append(bytes(buf[offset:offset + length]))
+            offset += length
+        entry[name] = values
+    return entry, offset
+
+
+class SyncCache(object):
+    """Local copy of users entries, after the first full search only entries modified
+    since the last run are retrieved"""
+    MODIFY_ATTR = 'modifyTimestamp'
+    NO_ATTRS = ['1.1']
+
+    def __init__(self, path):
+        logger.debug('Opening sync cache at %s', path)
+        # Daemon mode syncs from a background thread, but never concurrently
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    dn TEXT PRIMARY KEY,
+                    entry BLOB NOT NULL
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            ''')
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def sync(self, database, query='(uid=*)', attrs=None, **search):
+        """Updates the cache with entries modified since the last sync, removes the ones
+        no longer returned by `query` and yields all cached entries. `search` arguments
+        are passed to `LDAPDatabase.get_users`"""
+        attrs = list(LDAPDatabase.DEFAULT_ATTRS if attrs is None else attrs)
+        if self.MODIFY_ATTR not in attrs and '+' not in attrs:
+            attrs.append(self.MODIFY_ATTR)
+
+        signature = search_signature(database.base_dn, query, attrs, search.get('scope'))
+        high_water_mark = None
+        if self.get_meta('signature') == signature:
+            high_water_mark = self.get_meta('high_water_mark')
+
+        with self.conn:
+            if high_water_mark is None:
+                logger.info('Sync cache is empty or outdated, retrieving all users')
+                self.conn.execute('DELETE FROM entries')
+                users = database.get_users(query, attrs=attrs, **search)
+            else:
+                logger.info('Retrieving users modified since %s', high_water_mark)
+                self.remove_deleted(database, query, **search)
+                users = database.get_users(
+                    LDAPDatabase.and_query(query, '({}>={})'.format(
+                        self.MODIFY_ATTR, high_water_mark)),
+                    attrs=attrs,
+                    **search
+                )
+
+            updated = 0
+            for updated, (dn, record) in enumerate(users, 1):
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO entries (dn, entry) VALUES (?, ?)',
+                    (dn, encode_entry(record.raw)),
+                )
+                modified = record.get(self.MODIFY_ATTR)
+                if modified and (high_water_mark is None or modified[0] > high_water_mark):
+                    high_water_mark = modified[0]
+            logger.info('Updated %d users in sync cache', updated)
+
+            self.set_meta('signature', signature)
+            if high_water_mark is not None:
+                self.set_meta('high_water_mark', high_water_mark)
+
+        for dn, entry in self.conn.execute('SELECT dn, entry FROM entries'):
+            yield dn, LDAPRecord(decode_entry(entry)[0])
+
+    def remove_deleted(self, database, query, **search):
+        # Retrieving only DNs is cheap, entries missing from it were deleted or
+        # do not match the query anymore
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS current (dn TEXT PRIMARY KEY)')
+        self.conn.execute('DELETE FROM current')
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO current (dn) VALUES (?)',
+            ((dn,) for dn, _ in database.get_users(query, attrs=self.NO_ATTRS, **search)),
+        )
+        deleted = self.conn.execute(
+            'DELETE FROM entries WHERE dn NOT IN (SELECT dn FROM current)').rowcount
+        logger.info('Removed %d users from sync cache', deleted)
+
+    def close(self):
+        self.conn.close()
+
+
+class Snapshot(object):
+    """File with the users retrieved by a run, following runs within `ttl` seconds read
+    users from it instead of searching them. Entries are read from a memory map, so
+    they are decoded as they are iterated"""
+    MAGIC = b'LENSNAP1'
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def is_valid(self, signature):
+        try:
+            if time.time() - os.path.getmtime(self.path) > self.ttl:
+                return False
+            with open(self.path, 'rb') as f:
+                return self._read_header(f.read(len(self.MAGIC) + _VALUE.size)) \
+                    and self._read_signature(f) == signature
+        except (OSError, ValueError):
+            return False
+
+    def _read_header(self, header):
+        if len(header) != len(self.MAGIC) + _VALUE.size or not header.startswith(self.MAGIC):
+            raise ValueError('Invalid snapshot file {}'.format(self.path))
+        return True
+
+    def _read_signature(self, f):
+        f.seek(len(self.MAGIC))
+        length, = _VALUE.unpack(f.read(_VALUE.size))
+        return f.read(length).decode('utf-8')
+
+    def read(self):
+        logger.info('Reading users from snapshot %s', self.path)
+        with open(self.path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header(buf[:len(self.MAGIC) + _VALUE.size])
+            length, = _VALUE.unpack_from(buf, len(self.MAGIC))
+            offset = len(self.MAGIC) + _VALUE.size + length
+            while offset < len(buf):
+                dn_length, = _VALUE.unpack_from(buf, offset)
+                offset += _VALUE.size
+                dn = buf[offset:offset + dn_length].decode('utf-8')
+                entry, offset = decode_entry(buf, offset + dn_length)
+                yield dn, LDAPRecord(entry)
+        finally:
+            buf.close()
+
+    def write(self, users, signature):
+        """Yields `users` while writing them to the snapshot, it is only replaced
+        once all of them were written"""
+        logger.info('Writing users to snapshot %s', self.path)
+        tmp_path = '{}.tmp'.format(self.path)
+        completed = False
+        try:
+            with open(tmp_path, 'wb') as f:
+                signature = signature.encode('utf-8')
+                f.write(self.MAGIC + _VALUE.pack(len(signature)) + signature)
+                for dn, record in users:
+                    name = dn.encode('utf-8')
+                    f.write(_VALUE.pack(len(name)) + name + encode_entry(record.raw))
+                    yield dn, record
+            os.replace(tmp_path, self.path)
+            completed = True
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
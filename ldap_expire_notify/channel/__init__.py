@@ -11,6 +11,7 @@ except ImportError:
     from yaml import Loader as YAMLLoader
 
 
+from .base import WorkerBudget, configure_templates
 from .email import EmailChannel
 from .webhook import WebhookChannel
 
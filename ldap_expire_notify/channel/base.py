@@ -1,26 +1,199 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import hashlib
 import threading
 import logging
 import datetime
-from queue import Queue
+from collections import defaultdict
+from queue import Empty, Queue
+
+import jinja2
+from jinja2 import nodes
+
+from .ratelimit import RetryScheduler, Throttled, TokenBucket
 
 logger = logging.getLogger('ldap-expire-notify')
 
 
+class SourceLoader(jinja2.BaseLoader):
+    """Loads templates named after the hash of their source, so compiled templates can be
+    shared and cached by their source"""
+
+    def __init__(self):
+        self.sources = {}
+
+    def add(self, source):
+        name = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        self.sources[name] = source
+        return name
+
+    def get_source(self, environment, name):
+        try:
+            source = self.sources[name]
+        except KeyError:
+            raise jinja2.TemplateNotFound(name)
+        return source, None, lambda: True
+
+
+# All channel templates are built by this environment
+loader = SourceLoader()
+environment = jinja2.Environment(loader=loader)
+
+
+def configure_templates(cache_dir=None):
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        environment.bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+    else:
+        environment.bytecode_cache = None
+
+
+def is_ldap_entry(node):
+    """Whether a template node is `ldap` or an `ldap` entry of another variable,
+    like `task.ldap` in batch templates"""
+    if isinstance(node, nodes.Name):
+        return node.name == 'ldap'
+    if isinstance(node, nodes.Getattr):
+        return node.attr == 'ldap'
+    return isinstance(node, nodes.Getitem) and \
+        isinstance(node.arg, nodes.Const) and node.arg.value == 'ldap'
+
+
+def ldap_attributes(source):
+    """Returns the LDAP attributes referenced as `ldap.<attr>` or `ldap['<attr>']`
+    in a template source, or None if the `ldap` entry is used in any other way
+    (so the attributes it needs cannot be known in advance)"""
+    ast = environment.parse(source)
+    attrs = set()
+    accessed = 0
+    for node in ast.find_all((nodes.Getattr, nodes.Getitem)):
+        if not is_ldap_entry(node.node):
+            continue
+        if isinstance(node, nodes.Getattr):
+            attrs.add(node.attr)
+        elif isinstance(node.arg, nodes.Const):
+            attrs.add(str(node.arg.value))
+        else:
+            return None
+        accessed += 1
+
+    references = sum(1 for n in ast.find_all((nodes.Name, nodes.Getattr, nodes.Getitem))
+                     if is_ldap_entry(n))
+    if references > accessed:
+        return None
+    return attrs
+
+
+class WorkerBudget(object):
+    """Process wide limit of worker threads shared by channels. A channel can always grow
+    up to its fair share of the limit, and beyond it only while no other channel waits"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.held = defaultdict(int)
+        self.waiting = set()
+        self.lock = threading.Lock()
+
+    def register(self, name):
+        with self.lock:
+            self.held[name] += 0
+
+    def fair_share(self):
+        return max(1, self.limit // max(1, len(self.held)))
+
+    def acquire(self, name, force=False):
+        with self.lock:
+            if not force:
+                over = self.held[name] >= self.fair_share()
+                if self.used >= self.limit or (over and self.waiting - {name}):
+                    self.waiting.add(name)
+                    return False
+            self.waiting.discard(name)
+            self.held[name] += 1
+            self.used += 1
+            return True
+
+    def release(self, name, count=1):
+        with self.lock:
+            self.held[name] -= count
+            self.used -= count
+
+    def satisfied(self, name):
+        with self.lock:
+            self.waiting.discard(name)
+
+    def contended(self, name):
+        """Whether channel holds more than its fair share while others wait for workers"""
+        with self.lock:
+            return self.held[name] > self.fair_share() and bool(self.waiting - {name})
+
+
 class Channel(object):
     __required_conf__ = []
+    # Workers are added when the queue would take longer than this to drain
+    SCALE_UP_DRAIN = 1.0
+    LATENCY_WEIGHT = 0.2
 
     def __init__(self, name, configuration):
         self.workers = []
         self.num_workers = int(configuration.get('workers', 10))
+        self.min_workers = int(configuration.get('min_workers', self.num_workers))
+        self.max_workers = int(configuration.get('max_workers',
+            max(self.num_workers, self.min_workers)))
+        self.idle_timeout = float(configuration.get('idle_timeout', 30))
+        self.budget = None
+        self.latency = None
+        self.running = False
+        self.spawned = False
+        self.workers_lock = threading.Lock()
         self.threshold = int(configuration['threshold'])
-        self.queue = Queue()
+        # Producers block when queue is full, so pending tasks stay bounded
+        self.queue = Queue(maxsize=int(configuration.get('queue_size', 0)))
+        self.renotify = configuration.get('renotify')
+        self.renotify = int(self.renotify) if self.renotify is not None else None
+        self.state = None
         self.name = name
+        self.templates = []
+        self.retries = None
         self.check_configuration(configuration)
 
-    def check_and_notify(self, expiration_time, user_dn, user_data):
-        now = datetime.datetime.now()
+        # Sends are spread over time to stay under the rate allowed by the provider
+        self.limiter = None
+        if configuration.get('rate') is not None:
+            rate = float(configuration['rate'])
+            burst = int(configuration.get('burst', 1))
+            if rate <= 0:
+                raise ValueError('rate must be greater than 0, got {}'.format(rate))
+            if burst < 1:
+                raise ValueError('burst must be greater than 0, got {}'.format(burst))
+            self.limiter = TokenBucket(rate, burst)
+
+        if self.min_workers < 0 or self.max_workers < max(1, self.min_workers):
+            raise ValueError('Invalid workers range {}-{}'.format(
+                self.min_workers, self.max_workers))
+
+    @property
+    def autoscale(self):
+        return self.min_workers < self.max_workers
+
+    def template(self, source):
+        self.templates.append(source)
+        return environment.get_template(loader.add(source))
+
+    def ldap_attributes(self):
+        attrs = set()
+        for source in self.templates:
+            template_attrs = ldap_attributes(source)
+            if template_attrs is None:
+                return None
+            attrs.update(template_attrs)
+        return attrs
+
+    def check_and_notify(self, expiration_time, user_dn, user_data, now=None):
+        now = datetime.datetime.now() if now is None else now
         if expiration_time - datetime.timedelta(seconds=self.threshold) < now:
             logger.debug(
                 'DN=%s "%s" notification threshold reached (%s < NOW[%s])',
@@ -29,16 +202,118 @@ class Channel(object):
                 expiration_time - datetime.timedelta(seconds=self.threshold),
                 now,
             )
-            logger.info('Notifying %s via %s', user_dn, self.name)
-            self.queue.put({
-                'dn': user_dn,
-                'ldap': user_data,
-                'expiration': expiration_time,
-            })
-            return True
+            return self.enqueue(expiration_time, user_dn, user_data, now)
 
         return False
 
+    def already_notified(self, expiration_time, user_dn, now):
+        if self.state is None:
+            return False
+        sent = self.state.last_sent(user_dn, self.name, expiration_time)
+        if sent is None:
+            return False
+        return self.renotify is None or now - sent < datetime.timedelta(seconds=self.renotify)
+
+    def enqueue(self, expiration_time, user_dn, user_data, now=None):
+        now = datetime.datetime.now() if now is None else now
+        if self.already_notified(expiration_time, user_dn, now):
+            logger.debug('DN=%s already notified via %s, skipping', user_dn, self.name)
+            return False
+
+        logger.info('Notifying %s via %s', user_dn, self.name)
+        self.put({
+            'dn': user_dn,
+            'ldap': user_data,
+            'expiration': expiration_time,
+        })
+        return True
+
+    def put(self, task):
+        if not self.spawned:
+            self.spawn()
+        self.queue.put(task)
+        if self.autoscale:
+            self.scale()
+
+    def scale(self):
+        """Adds a worker when queued tasks would take longer than SCALE_UP_DRAIN seconds
+        to be sent by current workers, based on the average notify latency"""
+        with self.workers_lock:
+            if not self.running or len(self.workers) >= self.max_workers:
+                return
+            workers = len(self.workers)
+            backlog = self.queue.qsize()
+            if workers > 0:
+                if self.latency is None:
+                    busy = backlog > workers
+                else:
+                    busy = backlog * self.latency / workers > self.SCALE_UP_DRAIN
+                if not busy:
+                    if self.budget is not None:
+                        self.budget.satisfied(self.name)
+                    return
+            self.add_worker()
+
+    def add_worker(self, force=False):
+        """Starts a new worker if the budget allows it, must hold workers_lock"""
+        if self.budget is not None and not self.budget.acquire(self.name, force):
+            return False
+        w = self.new_worker()
+        w.start()
+        self.workers.append(w)
+        logger.debug('Channel %s running %d workers', self.name, len(self.workers))
+        return True
+
+    def retire(self, worker, idle):
+        """Whether `worker` must exit. Idle workers exit above min_workers, busy ones give
+        their thread back when the channel is over its share of the budget"""
+        with self.workers_lock:
+            held = len(self.workers)
+            if not self.running or held <= self.min_workers:
+                return False
+            if idle:
+                # Tasks put meanwhile would be left without workers
+                if not self.queue.empty():
+                    return False
+                if self.budget is not None:
+                    self.budget.satisfied(self.name)
+            elif self.budget is None or not self.budget.contended(self.name):
+                return False
+            self.workers.remove(worker)
+            if self.budget is not None:
+                self.budget.release(self.name)
+            logger.debug('Channel %s running %d workers', self.name, len(self.workers))
+            return True
+
+    def observe(self, duration):
+        """Updates the moving average of notify latency"""
+        with self.workers_lock:
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += self.LATENCY_WEIGHT * (duration - self.latency)
+
+    def reserve(self):
+        """Takes a token from the channel rate limiter, returning the seconds to wait
+        before sending"""
+        if self.limiter is None:
+            return 0
+        return self.limiter.reserve()
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def retry(self, task, delay):
+        task['attempts'] = task.get('attempts', 0) + 1
+        logger.debug('Retrying %s via %s in %s seconds', task['dn'], self.name, delay)
+        self.retries.schedule(task, delay)
+
+    def notified(self, task):
+        if self.state is not None:
+            self.state.record(task['dn'], self.name, task['expiration'])
+
     def check_configuration(self, config):
         for k in self.__required_conf__ + ['threshold']:
             if k not in config:
@@ -46,20 +321,43 @@ class Channel(object):
                     k, self.name))
 
     def start(self):
-        logger.debug('Starting %d %s workers', self.num_workers, self.name)
-        for _ in range(self.num_workers):
-            w = self.new_worker()
-            w.start()
-            self.workers.append(w)
+        """Workers are spawned by the first notification, so channels that send nothing
+        do not start threads nor open connections"""
+        with self.workers_lock:
+            self.running = True
+
+    def spawn(self):
+        with self.workers_lock:
+            if self.spawned or not self.running:
+                return
+            logger.debug('Starting %d %s workers', self.min_workers, self.name)
+            self.retries = RetryScheduler(self.put)
+            self.retries.start()
+            for _ in range(self.min_workers):
+                self.add_worker(force=True)
+            self.spawned = True
 
     def stop(self):
         logger.debug('Stopping %s workers', self.name)
-        for _ in self.workers:
+        if self.retries is not None:
+            # Retried tasks come back to the queue, so finish signals must go after them
+            self.queue.join()
+            while self.retries.wait_idle():
+                self.queue.join()
+            self.retries.stop()
+            self.retries = None
+        with self.workers_lock:
+            self.running = False
+            self.spawned = False
+            workers = self.workers
+            self.workers = []
+        for _ in workers:
             self.queue.put(None)
-        if len(self.workers) > 0:
+        if len(workers) > 0:
             logger.debug('Joining %s workers', self.name)
             self.queue.join()
-        self.workers = []
+            if self.budget is not None:
+                self.budget.release(self.name, len(workers))
 
 
 class ChannelWorker(threading.Thread):
@@ -73,20 +371,40 @@ class ChannelWorker(threading.Thread):
     def log(self, msg, level=logging.INFO):
         logger.log(level, '%s: %s', self.name, msg)
 
+    def prepare(self, task):
+        task['threshold'] = self.channel.threshold
+        task['threshold_hour'] = task['threshold'] / 3600
+        task['threshold_day'] = task['threshold_hour'] / 24
+
     def run(self):
+        timeout = self.channel.idle_timeout if self.channel.autoscale else None
         while True:
-            task = self.queue.get()
+            try:
+                task = self.queue.get(timeout=timeout)
+            except Empty:
+                if self.channel.retire(self, idle=True):
+                    self.log('Idle, exiting', logging.DEBUG)
+                    break
+                continue
+
             if task is None:  # Notify tasks are done via sending None to the worker threads
                 self.log('Received finish signal', logging.DEBUG)
                 self.queue.task_done()
                 break
 
             try:
-                task['threshold'] = self.channel.threshold
-                task['threshold_hour'] = task['threshold'] / 3600
-                task['threshold_day'] = task['threshold_hour'] / 24
+                self.prepare(task)
+                started = time.monotonic()
                 self.notify(task)
+                self.channel.observe(time.monotonic() - started)
+                self.channel.notified(task)
+            except Throttled as e:
+                self.channel.retry(task, e.delay)
             except Exception as e:
                 logger.exception('Unable to notify task %s', task)
             finally:
                 self.queue.task_done()
+
+            if self.channel.budget is not None and self.channel.retire(self, idle=False):
+                self.log('Giving thread back to other channels', logging.DEBUG)
+                break
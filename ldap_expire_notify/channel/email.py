@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import time
 import logging
 import smtplib
+import threading
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-
-import jinja2
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
 
 from .base import Channel, ChannelWorker
 
@@ -23,75 +23,203 @@ class EmailChannel(Channel):
         self.pwd = None
         self.ssl = False
         self.starttls = False
-        self.subject_tmpl = jinja2.Template(configuration['subject'])
-        self.body_tmpl = jinja2.Template(configuration['body'])
-        self.recipient = jinja2.Template(configuration['recipient'])
-        self.from_ = jinja2.Template(configuration['from'])
-
-    def new_worker(self):
-        return EmailWorker(
-            self,
-            self.queue,
+        self.pool = None
+        self.max_messages = int(configuration.get('max_messages', 0))
+        self.subject_tmpl = self.template(configuration['subject'])
+        self.body_tmpl = self.template(configuration['body'])
+        self.recipient = self.template(configuration['recipient'])
+        self.from_ = self.template(configuration['from'])
+        self.body_text_tmpl = None
+        if 'body_text' in configuration:
+            self.body_text_tmpl = self.template(configuration['body_text'])
+
+    def start(self):
+        self.pool = SMTPPool(
             self.server,
             self.user,
             self.pwd,
             self.ssl,
             self.starttls,
+            self.max_messages,
+        )
+        super(EmailChannel, self).start()
+
+    def stop(self):
+        super(EmailChannel, self).stop()
+        if self.pool:
+            self.pool.close()
+
+    def new_worker(self):
+        return EmailWorker(
+            self,
+            self.queue,
+            self.pool,
             self.subject_tmpl,
             self.body_tmpl,
             self.recipient,
             self.from_,
+            self.body_text_tmpl,
         )
 
 
-class EmailWorker(ChannelWorker):
-    DEFAULT_PORT = 25
+class TextExtractor(HTMLParser):
+    """Collects the text of an HTML document, skipping scripts and styles"""
+    SKIP_TAGS = ('script', 'style')
+
+    def __init__(self):
+        super(TextExtractor, self).__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    parser = TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return ''.join(parser.parts)
+
+
+class PooledConnection(object):
+    __slots__ = ('conn', 'messages', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.messages = 0
+        self.last_used = time.time()
+
+
+class SMTPPool(object):
+    """SMTP connections shared by all workers of a channel. Connections are opened when
+    first needed, checked using NOOP when they were idle, reopened when the server drops
+    them and recycled after `max_messages` (if greater than 0)"""
+    IDLE_CHECK = 30
+
+    def __init__(self, server, user, pwd, ssl, starttls, max_messages=0):
+        self.server = server.split(':')[0]
+        # 0 means default port for SMTP or SMTP_SSL
+        self.port = int(server.split(':')[-1]) if ':' in server else 0
+        self.user = user
+        self.pwd = pwd
+        self.ssl = ssl
+        self.starttls = starttls
+        self.max_messages = max_messages
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        logger.debug('Connecting to SMTP server at %s', self.server)
+        if not self.ssl:
+            conn = smtplib.SMTP(self.server, self.port)
+        else:
+            conn = smtplib.SMTP_SSL(self.server, self.port)
 
+        if self.starttls:
+            conn.starttls()
+            conn.ehlo()
+
+        if self.user and self.pwd:
+            conn.login(self.user, self.pwd)
+
+        return PooledConnection(conn)
+
+    @staticmethod
+    def is_alive(pooled):
+        try:
+            return pooled.conn.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def acquire(self):
+        pooled = None
+        with self.lock:
+            if self.idle:
+                pooled = self.idle.pop()
+
+        if pooled is not None and time.time() - pooled.last_used > self.IDLE_CHECK \
+                and not self.is_alive(pooled):
+            logger.debug('SMTP connection to %s is not alive, reconnecting', self.server)
+            self.discard(pooled)
+            pooled = None
+
+        return pooled or self.connect()
+
+    def release(self, pooled):
+        pooled.last_used = time.time()
+        if self.max_messages > 0 and pooled.messages >= self.max_messages:
+            logger.debug('SMTP connection sent %d messages, recycling it', pooled.messages)
+            self.discard(pooled)
+            return
+        with self.lock:
+            self.idle.append(pooled)
+
+    def discard(self, pooled):
+        try:
+            pooled.conn.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        # Dropped connections are retried once using a new one
+        for retry in range(2):
+            pooled = self.acquire()
+            try:
+                result = pooled.conn.sendmail(from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                self.discard(pooled)
+                if retry:
+                    raise
+                logger.debug('SMTP server %s closed connection, reconnecting', self.server)
+                continue
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+                # Connection is still usable after the server refuses a message
+                self.release(pooled)
+                raise
+            except Exception:
+                self.discard(pooled)
+                raise
+
+            pooled.messages += 1
+            self.release(pooled)
+            return result
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for pooled in idle:
+            logger.debug('Closing SMTP connection')
+            self.discard(pooled)
+
+
+class EmailWorker(ChannelWorker):
     def __init__(self,
         channel,
         queue,
-        server,
-        user,
-        pwd,
-        ssl,
-        starttls,
+        pool,
         subject_tmpl,
         body_tmpl,
         recipient,
-        from_
+        from_,
+        body_text_tmpl=None
     ):
         super(EmailWorker, self).__init__(channel, queue)
-        self.server = server.split(':')[0]
-        self.port = server.split(':')[-1] if ':' in server else self.DEFAULT_PORT
-        self.user = user
-        self.pwd = pwd
-        self.ssl = ssl
-        self.starttls = starttls
+        self.pool = pool
         self.subject_tmpl = subject_tmpl
         self.body_tmpl = body_tmpl
         self.recipient = recipient
         self.from_ = from_
-        self.conn = None
-        self._connect()
-
-    def __del__(self):
-        if self.conn:
-            self.log('Closing SMTP connection', logging.DEBUG)
-            self.conn.quit()
-            self.conn = None
-
-    def _connect(self):
-        self.log('Connecting to SMTP server at {}'.format(self.server), logging.DEBUG)
-        if not self.ssl:
-            self.conn = smtplib.SMTP(self.server, self.port)
-        else:
-            self.conn = smtplib.SMTP_SSL(self.server)
-
-        if self.user and self.pwd:
-            self.conn.login(self.user, self.pwd)
-
-        if self.starttls:
-            self.conn.starttls()
+        self.body_text_tmpl = body_text_tmpl
 
     def notify(self, data):
         recipient = self.recipient.render(data)
@@ -108,6 +236,11 @@ class EmailWorker(ChannelWorker):
         msg['Subject'] = subject
         msg['From'] = from_
         msg['To'] = recipient
-        msg.attach(MIMEText(BeautifulSoup(body, features="html.parser").get_text(), 'text'))
+        if self.body_text_tmpl:
+            text = self.body_text_tmpl.render(data)
+        else:
+            text = html_to_text(body)
+        msg.attach(MIMEText(text, 'text'))
         msg.attach(MIMEText(body, 'html'))
-        self.conn.sendmail(from_, [recipient], msg.as_string())
+        self.channel.acquire()
+        self.pool.sendmail(from_, [recipient], msg.as_string())
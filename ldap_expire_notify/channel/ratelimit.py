@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger('ldap-expire-notify')
+
+
+class Throttled(Exception):
+    """Raised by workers when a notification must be retried after `delay` seconds"""
+
+    def __init__(self, delay):
+        super(Throttled, self).__init__('Throttled, retry in {} seconds'.format(delay))
+        self.delay = delay
+
+
+class TokenBucket(object):
+    """Thread safe token bucket allowing `rate` operations per second with bursts of
+    up to `burst` operations"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token, returning the seconds to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Tokens go negative so following callers wait for their own turn
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RetryScheduler(threading.Thread):
+    """Puts tasks back into a queue using `put` once their retry delay is over, so tasks
+    waiting for a retry do not hold worker threads"""
+
+    def __init__(self, put):
+        super(RetryScheduler, self).__init__(daemon=True)
+        self.put = put
+        self.heap = []
+        self.moving = 0
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.stopped = False
+        # This is for informative logging
+        self.name = '{}-{}'.format(self.__class__.__name__, self.name.split('-')[-1])
+
+    def schedule(self, task, delay):
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), task))
+            self.cond.notify_all()
+
+    def pending(self):
+        with self.cond:
+            return len(self.heap) + self.moving
+
+    def wait_idle(self):
+        """Waits until every scheduled task is back in the queue, returns whether
+        there were any"""
+        with self.cond:
+            waited = False
+            while self.heap or self.moving:
+                waited = True
+                self.cond.wait()
+            return waited
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                if self.stopped:
+                    return
+                _, _, task = heapq.heappop(self.heap)
+                self.moving += 1
+
+            # Queue may be bounded, do not block schedule() while waiting for room
+            self.put(task)
+            with self.cond:
+                self.moving -= 1
+                self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
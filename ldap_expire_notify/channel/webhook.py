@@ -1,27 +1,46 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import datetime
 import logging
-import jinja2
 import requests
 import time
 
+from email.utils import parsedate_to_datetime
+from queue import Empty
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 from .base import Channel, ChannelWorker
+from .ratelimit import Throttled
 
 logger = logging.getLogger('ldap-expire-notify')
 
 
 class WebhookChannel(Channel):
     __required_conf__ = ['url']
+    ENGINES = ('threads', 'async')
 
     def __init__(self, name, configuration):
         super(WebhookChannel, self).__init__(name, configuration)
-        self.url = jinja2.Template(configuration['url'])
+        self.url = self.template(configuration['url'])
         self.method = str.upper(configuration.get('method', 'get'))
         self.throttle_code = int(configuration.get('throttle_code', '429'))
         self.throttle_retries = int(configuration.get('throttle_retries', '5'))
         self.throttle_max_sleep = int(configuration.get('throttle_max_sleep', '30'))
-        self.body_tmpl = jinja2.Template(configuration.get('body', ''))
+        self.body_tmpl = self.template(configuration.get('body', ''))
         self.headers = configuration.get('headers', [])
+        self.pool_size = int(configuration.get('pool_size', self.max_workers))
+        self.session = None
+        self.engine = configuration.get('engine', 'threads')
+        self.concurrency = int(configuration.get('concurrency', '100'))
+        self.batch_size = int(configuration.get('batch_size', '1'))
+        self.batch_max_wait = float(configuration.get('batch_max_wait', '5'))
+        self.batch_body_tmpl = None
 
         if self.throttle_retries < 1:
             raise ValueError('throttle_retries must be greater than 0, got {}'.format(
@@ -31,10 +50,87 @@ class WebhookChannel(Channel):
             raise ValueError('throttle_max_sleep must be greater than 0, got {}'.format(
                 self.throttle_max_sleep))
 
+        if self.pool_size < 1:
+            raise ValueError('pool_size must be greater than 0, got {}'.format(
+                self.pool_size))
+
+        if self.engine not in self.ENGINES:
+            raise ValueError('engine must be one of {}, got {}'.format(
+                ', '.join(self.ENGINES), self.engine))
+
+        if self.engine == 'async':
+            if aiohttp is None:
+                raise ValueError('engine async requires aiohttp to be installed')
+            if self.concurrency < 1:
+                raise ValueError('concurrency must be greater than 0, got {}'.format(
+                    self.concurrency))
+            # A single event loop thread keeps up to concurrency requests in flight
+            self.num_workers = self.min_workers = self.max_workers = 1
+
+        if self.batch_size < 1:
+            raise ValueError('batch_size must be greater than 0, got {}'.format(
+                self.batch_size))
+
+        if self.batch_size > 1:
+            if self.engine == 'async':
+                raise ValueError('batch_size is not supported by the async engine')
+            if self.autoscale:
+                raise ValueError('min_workers and max_workers are not supported with batch_size')
+            if self.batch_max_wait <= 0:
+                raise ValueError('batch_max_wait must be greater than 0, got {}'.format(
+                    self.batch_max_wait))
+            if 'batch_body' not in configuration:
+                raise ValueError('batch_body is required when batch_size is greater than 1')
+            self.batch_body_tmpl = self.template(configuration['batch_body'])
+
+    def start(self):
+        if self.engine == 'async':
+            super(WebhookChannel, self).start()
+            return
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        super(WebhookChannel, self).start()
+
+    def stop(self):
+        super(WebhookChannel, self).stop()
+        if self.session:
+            self.session.close()
+
     def new_worker(self):
+        if self.engine == 'async':
+            return AsyncWebhookWorker(
+                self,
+                self.queue,
+                self.concurrency,
+                self.throttle_code,
+                self.throttle_retries,
+                self.throttle_max_sleep,
+                self.url,
+                self.body_tmpl,
+                self.method,
+                self.headers,
+            )
+        if self.batch_size > 1:
+            return BatchWebhookWorker(
+                self,
+                self.queue,
+                self.batch_size,
+                self.batch_max_wait,
+                self.session,
+                self.throttle_code,
+                self.throttle_retries,
+                self.throttle_max_sleep,
+                self.url,
+                self.batch_body_tmpl,
+                self.method,
+                self.headers,
+            )
         return WebhookWorker(
             self,
             self.queue,
+            self.session,
             self.throttle_code,
             self.throttle_retries,
             self.throttle_max_sleep,
@@ -51,6 +147,7 @@ class WebhookWorker(ChannelWorker):
     def __init__(self,
             channel,
             queue,
+            session,
             throttle_code,
             throttle_retries,
             throttle_max_sleep,
@@ -60,6 +157,7 @@ class WebhookWorker(ChannelWorker):
             headers
     ):
         super(WebhookWorker, self).__init__(channel, queue)
+        self.session = session
         self.throttle_code = throttle_code
         self.throttle_retries = throttle_retries
         self.throttle_max_sleep = throttle_max_sleep
@@ -68,7 +166,7 @@ class WebhookWorker(ChannelWorker):
         self.method = method
         self.headers = headers
 
-    def notify(self, data):
+    def render(self, data):
         url = self.url_tmpl.render(data)
         body = None
         if self.body_tmpl:
@@ -78,26 +176,210 @@ class WebhookWorker(ChannelWorker):
             self.method,
             ' '.join(self.headers),
         ), logging.DEBUG)
+        return url, body
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait before retrying a throttled request, honoring Retry-After
+        header if present"""
+        if retry_after:
+            try:
+                return max(0, int(retry_after))
+            except ValueError:
+                pass
+            try:
+                date = parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                pass
+            else:
+                if date.tzinfo is None:
+                    date = date.replace(tzinfo=datetime.timezone.utc)
+                now = datetime.datetime.now(datetime.timezone.utc)
+                return max(0, (date - now).total_seconds())
+        return min(2 ** (attempt - 1), self.throttle_max_sleep)
+
+    def notify(self, data):
+        url, body = self.render(data)
+
+        self.channel.acquire()
+        r = self.session.request(self.method,
+            url,
+            data=body,
+            headers=self.headers,
+            timeout=self.DEFAULT_TIMEOUT
+        )
+        if r.status_code == self.throttle_code:
+            attempt = data.get('attempts', 0) + 1
+            if attempt >= self.throttle_retries:
+                raise RuntimeError('All requests to {} were throttled'.format(url))
+            delay = self.backoff(attempt, r.headers.get('Retry-After'))
+            self.log('Got throttle_code {}, retrying in {} seconds, {} out of {} retries'.format(
+                r.status_code,
+                delay,
+                attempt,
+                self.throttle_retries,
+            ))
+            raise Throttled(delay)
+
+        self.log('Got {}: {}'.format(r.status_code, r.content), logging.DEBUG)
+
+
+class BatchWebhookWorker(WebhookWorker):
+    """Sends up to batch_size tasks per request, waiting at most batch_max_wait
+    seconds since the first task of a batch before sending it"""
+
+    def __init__(self, channel, queue, batch_size, batch_max_wait, *args):
+        super(BatchWebhookWorker, self).__init__(channel, queue, *args)
+        self.batch_size = batch_size
+        self.batch_max_wait = batch_max_wait
+
+    def next_batch(self):
+        """Returns the next batch of tasks and whether finish signal was received"""
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            try:
+                task = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if task is None:
+                return batch, True
+            self.prepare(task)
+            batch.append(task)
+            if deadline is None:
+                deadline = time.monotonic() + self.batch_max_wait
+        return batch, False
+
+    def run(self):
+        finished = False
+        while not finished:
+            batch, finished = self.next_batch()
+            if not batch:
+                continue
+
+            data = {
+                'tasks': batch,
+                'attempts': max(task.get('attempts', 0) for task in batch),
+            }
+            self.prepare(data)
+            try:
+                self.notify(data)
+                for task in batch:
+                    self.channel.notified(task)
+            except Throttled as e:
+                for task in batch:
+                    self.channel.retry(task, e.delay)
+            except Exception as e:
+                logger.exception('Unable to notify batch of %d tasks: %s',
+                    len(batch), ', '.join(task['dn'] for task in batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+        # Finish signal is acknowledged once pending tasks are sent
+        self.log('Received finish signal', logging.DEBUG)
+        self.queue.task_done()
+
+
+class AsyncWebhookWorker(WebhookWorker):
+    """Delivers webhooks concurrently from an asyncio event loop in its own thread"""
+
+    def __init__(self,
+            channel,
+            queue,
+            concurrency,
+            throttle_code,
+            throttle_retries,
+            throttle_max_sleep,
+            url_tmpl,
+            body_tmpl,
+            method,
+            headers
+    ):
+        super(AsyncWebhookWorker, self).__init__(
+            channel,
+            queue,
+            None,
+            throttle_code,
+            throttle_retries,
+            throttle_max_sleep,
+            url_tmpl,
+            body_tmpl,
+            method,
+            headers,
+        )
+        self.concurrency = concurrency
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.consume(loop))
+        finally:
+            loop.close()
+
+    async def consume(self, loop):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            while True:
+                # Channel queue is shared with producer threads, wait for it off the loop
+                task = await loop.run_in_executor(None, self.queue.get)
+                if task is None:
+                    self.log('Received finish signal', logging.DEBUG)
+                    break
+
+                await semaphore.acquire()
+                future = asyncio.ensure_future(self.handle(session, task))
+                pending.add(future)
+                future.add_done_callback(pending.discard)
+                future.add_done_callback(lambda _: semaphore.release())
+
+            if pending:
+                await asyncio.wait(pending)
+        self.queue.task_done()
+
+    async def handle(self, session, task):
+        try:
+            self.prepare(task)
+            await self.deliver(session, task)
+            self.channel.notified(task)
+        except Exception:
+            logger.exception('Unable to notify task %s', task)
+        finally:
+            self.queue.task_done()
+
+    async def deliver(self, session, data):
+        url, body = self.render(data)
+        timeout = aiohttp.ClientTimeout(total=self.DEFAULT_TIMEOUT)
 
-        sleep = 1
         for i in range(self.throttle_retries):
-            r = requests.request(self.method,
+            delay = self.channel.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with session.request(self.method,
                 url,
                 data=body,
                 headers=self.headers,
-                timeout=self.DEFAULT_TIMEOUT
-            )
-            if r.status_code == self.throttle_code:
-                self.log('Got throttle_code {}, sleeping {} seconds, {} out of {} retries'.format(
-                    r.status_code,
-                    sleep,
+                timeout=timeout
+            ) as r:
+                content = await r.read()
+            if r.status != self.throttle_code:
+                self.log('Got {}: {}'.format(r.status, content), logging.DEBUG)
+                return
+            if i + 1 < self.throttle_retries:
+                delay = self.backoff(i + 1, r.headers.get('Retry-After'))
+                self.log('Got throttle_code {}, retrying in {} seconds, {} out of {} retries'.format(
+                    r.status,
+                    delay,
                     i + 1,
                     self.throttle_retries,
                 ))
-                time.sleep(sleep)
-                sleep = min(2 * sleep, self.throttle_max_sleep)
-            else:
-                self.log('Got {}: {}'.format(r.status_code, r.content), logging.DEBUG)
-                break
-        else:
-            raise RuntimeError('All requests to {} were throttled'.format(url))
+                await asyncio.sleep(delay)
+
+        raise RuntimeError('All requests to {} were throttled'.format(url))
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import signal
 import logging
+import datetime
 import click
 import click_log
 import ldap
@@ -9,6 +11,10 @@ from collections import defaultdict
 from . import database
 from . import channel
 from . import utils
+from . import evaluate
+from . import state
+from . import cache
+from . import daemon
 
 logger = logging.getLogger('ldap-expire-notify')
 click_log.basic_config(logger)
@@ -31,17 +37,33 @@ click_log.basic_config(logger)
         default=False, help='Ignore LDAP Certificate when binding (not recommended)')
 @click.option('--users-query', '-q', envvar='LDAP_QUERY',
         default='(uid=*)', help='Query used to retrieve all users')
+@click.option('--cutoff-filter/--no-cutoff-filter', envvar='LDAP_CUTOFF_FILTER',
+        default=False, help='Only query users that may reach any channel threshold')
 @click.option('--user-attrs', '-f', multiple=True,
         default=['*', '+'], help='User attributes to be retrieved')
+@click.option('--auto-attrs/--no-auto-attrs', envvar='LDAP_AUTO_ATTRS',
+        default=False, help='Only retrieve user attributes used by channel templates')
 @click.option('--query-scope', envvar='LDAP_SCOPE',
         type=click.Choice(['BASE', 'ONELEVEL', 'SUBTREE']),
         default='SUBTREE', help='Query used to retrieve all users')
+@click.option('--page-size', envvar='LDAP_PAGE_SIZE', type=int,
+        default=0, help='Retrieve users in pages of this size, 0 disables paging')
+@click.option('--shard', '-s', multiple=True, help='Split users search in shards run in \
+        parallel, either a sub base DN or a filter ANDed to users query')
+@click.option('--search-workers', type=int,
+        default=0, help='Connections used to search shards, 0 uses one per shard')
+@click.option('--prefetch', envvar='LDAP_PREFETCH', type=int,
+        default=0, help='Fetch users in background buffering up to this number, 0 disables it')
 @click.option('--modify-attr', '-e',
         default='pwdChangedTime', help='Attribute where password modification time is stored')
 @click.option('--modify-format',
         default='%Y%m%d%H%M%SZ', help='Modification time strptime format')
+@click.option('--skip-recent/--no-skip-recent', envvar='LDAP_SKIP_RECENT', default=False,
+        help='Skip users that can not be notified comparing raw GeneralizedTime values')
 @click.option('--pwd-max-age', '-M', type=int,
         default=31536000, help='Maximum password age in seconds')
+@click.option('--batch-size', type=int, default=0,
+        help='Evaluate channel thresholds for batches of this many users, 0 disables it')
 @click.option('--smtp-server', envvar='SMTP_SERVER',
         help='SMTP server used to send emails')
 @click.option('--smtp-user', envvar='SMTP_USER',
@@ -54,6 +76,22 @@ click_log.basic_config(logger)
         default=False, help='Use STARTTLS SMTP connection')
 @click.option('--channels', '-c', envvar='CHANNELS', required=True, help='Channels configuration, \
         can be a json/yaml file or a folder containing json/yaml files')
+@click.option('--template-cache', envvar='TEMPLATE_CACHE',
+        help='Folder where compiled channel templates are cached')
+@click.option('--max-threads', envvar='MAX_THREADS', type=int, default=0,
+        help='Maximum worker threads added on demand by all channels, 0 means unlimited')
+@click.option('--sync-cache', envvar='SYNC_CACHE',
+        help='SQLite file where users are cached, only modified users are retrieved')
+@click.option('--snapshot', envvar='SNAPSHOT',
+        help='File where retrieved users are stored and read by following runs')
+@click.option('--snapshot-ttl', envvar='SNAPSHOT_TTL', type=int,
+        default=3600, help='Seconds a snapshot is used before searching users again')
+@click.option('--daemon/--no-daemon', envvar='DAEMON', default=False,
+        help='Keep running and notify users as soon as they reach channel thresholds')
+@click.option('--refresh-interval', envvar='REFRESH_INTERVAL', type=int,
+        default=3600, help='Seconds between users searches in daemon mode')
+@click.option('--state-file', envvar='STATE_FILE',
+        help='SQLite file where sent notifications are stored to avoid duplicates')
 @click_log.simple_verbosity_option(logger)
 def main(**kwargs):
 
@@ -62,20 +100,14 @@ def main(**kwargs):
         v = '*****' if k in hidden_params else v
         logger.info('Parameter %-15s => %s', k, v)
 
-    logger.info('Connecting to LDAP Directory')
-    try:
-        ldap_db = database.LDAPDatabase(
-            kwargs.get('host'),
-            kwargs.get('port'),
-            kwargs.get('bind_dn'),
-            kwargs.get('pwd'),
-            kwargs.get('base_dn'),
-        )
-    except ValueError:
-        utils.die('Invalid variable connecting to LDAP')
-    except ldap.LDAPError:
-        utils.die('Unable to connect to LDAP')
+    state_store = None
+    if kwargs.get('state_file'):
+        try:
+            state_store = state.StateStore(kwargs.get('state_file'))
+        except Exception:
+            utils.die('Unable to open state file')
 
+    channel.configure_templates(kwargs.get('template_cache'))
     try:
         channels = utils.start_channels(
             kwargs.get('channels'),
@@ -83,7 +115,9 @@ def main(**kwargs):
             kwargs.get('smtp_user'),
             kwargs.get('user_pwd'),
             kwargs.get('smtp_ssl'),
-            kwargs.get('smtp_starttls')
+            kwargs.get('smtp_starttls'),
+            state_store,
+            kwargs.get('max_threads'),
         )
     except Exception:
         utils.die('Unable to start channels')
@@ -92,43 +126,170 @@ def main(**kwargs):
     modify_format = kwargs.get('modify_format')
     max_age = kwargs.get('pwd_max_age')
 
-    notifications = defaultdict(int)
-    users = 0  # Avoid issues with empty result sets
-    db_users = ldap_db.get_users(
-        kwargs.get('users_query'),
-        kwargs.get('query_scope'),
-        kwargs.get('user_attrs'),
-    )
-    for users, (user_dn, user_data) in enumerate(db_users, 1):
+    user_attrs = kwargs.get('user_attrs')
+    if kwargs.get('auto_attrs'):
+        user_attrs = utils.get_channels_attributes(channels, modify_field) or user_attrs
+        logger.info('Retrieving user attributes: %s', ', '.join(user_attrs))
+
+    cutoff_filter = kwargs.get('cutoff_filter')
+    if cutoff_filter and (kwargs.get('sync_cache') or kwargs.get('snapshot')):
+        # Users retrieved by previous runs would be missing once the cutoff moves
+        logger.warning('Cutoff filter can not be used with sync cache or snapshot, ignoring it')
+        cutoff_filter = False
+
+    skip_recent = kwargs.get('skip_recent')
+    if skip_recent and modify_format != utils.GENERALIZED_TIME_FORMAT:
+        logger.warning('Unable to skip recent users, modify format is not GeneralizedTime')
+        skip_recent = False
+
+    snapshot = None
+    if kwargs.get('snapshot') and kwargs.get('daemon'):
+        logger.warning('Snapshot can not be used in daemon mode, ignoring it')
+    elif kwargs.get('snapshot'):
+        snapshot = cache.Snapshot(kwargs.get('snapshot'), kwargs.get('snapshot_ttl'))
+
+    sync_cache = None
+    if kwargs.get('sync_cache'):
+        sync_cache = cache.SyncCache(kwargs.get('sync_cache'))
+
+    search = {
+        'scope': kwargs.get('query_scope'),
+        'page_size': kwargs.get('page_size'),
+        'shards': kwargs.get('shard'),
+        'workers': kwargs.get('search_workers'),
+        'prefetch': kwargs.get('prefetch'),
+    }
+    ldap_db = None
+
+    def connect():
+        nonlocal ldap_db
+        if ldap_db is not None:
+            return ldap_db
+
+        logger.info('Connecting to LDAP Directory')
         try:
-            expiration_time = utils.get_user_expiration_time(
-                user_data.get(modify_field),
-                modify_format,
-                max_age,
+            ldap_db = database.LDAPDatabase(
+                kwargs.get('host'),
+                kwargs.get('port'),
+                kwargs.get('bind_dn'),
+                kwargs.get('pwd'),
+                kwargs.get('base_dn'),
+                # Daemon connection is kept open, so transparently reconnect when lost
+                retry_max=5 if kwargs.get('daemon') else 0,
             )
-        except utils.MissingModify as e:
-            logger.error('User DN=%s: %s', user_dn, e)
-            continue
+        except ValueError:
+            utils.stop_channels(channels)
+            utils.die('Invalid variable connecting to LDAP')
+        except ldap.LDAPError:
+            utils.stop_channels(channels)
+            utils.die('Unable to connect to LDAP')
+        return ldap_db
+
+    def fetch(now):
+        # Users that may reach any channel threshold at `now`
+        # Formatting may drop fractions of second, round up to never miss any user
+        cutoff = utils.get_notify_cutoff(channels, max_age, now) + datetime.timedelta(seconds=1)
+
+        users_query = kwargs.get('users_query')
+        if cutoff_filter:
+            users_query = database.LDAPDatabase.cutoff_query(
+                users_query,
+                modify_field,
+                cutoff.strftime(modify_format),
+            )
+            logger.info('Using users query %s', users_query)
+
+        skip_cutoff = None
+        if skip_recent:
+            skip_cutoff = cutoff.strftime(utils.GENERALIZED_TIME_FORMAT)
+
+        signature = cache.search_signature(kwargs.get('base_dn'), users_query, user_attrs,
+            search['scope'])
+        if snapshot and snapshot.is_valid(signature):
+            db_users = snapshot.read()
+        else:
+            if sync_cache:
+                db_users = sync_cache.sync(connect(), users_query, user_attrs, **search)
+            else:
+                db_users = connect().get_users(users_query, attrs=user_attrs, **search)
+            if snapshot:
+                db_users = snapshot.write(db_users, signature)
 
-        logger.info('DN=%s password will expire at %s', user_dn, expiration_time)
+        return utils.expiring_users(db_users, modify_field, modify_format, max_age, skip_cutoff)
 
+    # Reference time used for the whole run
+    index = evaluate.ThresholdIndex(channels)
+
+    if kwargs.get('daemon'):
+        connect()
+        run_daemon(index, fetch, kwargs.get('refresh_interval'))
+    else:
+        notifications = run_once(channels, index, fetch, kwargs.get('batch_size'))
         for cname, cinfo in channels.items():
-            if cinfo.check_and_notify(expiration_time, user_dn, user_data):
+            logger.info('Sent %d notifications to %s channel', notifications[cname], cname)
+
+    utils.stop_channels(channels)
+    if state_store:
+        state_store.close()
+    if sync_cache:
+        sync_cache.close()
+
+
+def run_once(channels, index, fetch, batch_size):
+    notifications = defaultdict(int)
+    batch = []
+
+    def notify_batch(batch):
+        for (user_dn, user_data, expiration_time), cname in evaluate.evaluate(batch, index):
+            if channels[cname].enqueue(expiration_time, user_dn, user_data, index.now):
                 notifications[cname] += 1
 
-    logger.info('Processed %d users', users)
+    for user_dn, user_data, expiration_time in fetch(index.now):
+        if batch_size > 0:
+            batch.append((user_dn, user_data, expiration_time))
+            if len(batch) >= batch_size:
+                notify_batch(batch)
+                batch = []
+            continue
 
-    for cname, cinfo in channels.items():
-        logger.info('Sent %d notifications to %s channel', notifications[cname], cname)
+        for cname, cinfo in index.reached(expiration_time):
+            if cinfo.enqueue(expiration_time, user_dn, user_data, index.now):
+                notifications[cname] += 1
 
-    utils.stop_channels(channels)
+    notify_batch(batch)
+    return notifications
+
+
+def run_daemon(index, fetch, refresh_interval):
+    scheduler = daemon.Scheduler(index)
+    refresher = daemon.Refresher(scheduler, fetch, refresh_interval)
+
+    def shutdown(signum, frame):
+        logger.info('Received signal %d, stopping', signum)
+        scheduler.stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    logger.info('Running as daemon, refreshing users every %d seconds', refresh_interval)
+    refresher.start()
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        logger.info('Interrupted, stopping')
+    refresher.stop()
+
+    for cname, count in scheduler.notifications.items():
+        logger.info('Sent %d notifications to %s channel', count, cname)
 
 
 @click.command()
 @click.option('--channels', '-c', envvar='CHANNELS', required=True, help='Channels configuration, \
         can be a json/yaml file or a folder containing json/yaml files')
+@click.option('--template-cache', envvar='TEMPLATE_CACHE',
+        help='Folder where compiled channel templates are cached')
 @click_log.simple_verbosity_option(logger)
 def check_channels(**kwargs):
+    # Parsing channels compiles their templates, so they are stored in template cache
+    channel.configure_templates(kwargs.get('template_cache'))
     channels = channel.parse(kwargs.get('channels'))
     for cname, cinfo in channels.items():
         logger.info('-' * 50)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import datetime
+import itertools
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger('ldap-expire-notify')
+
+
+class Scheduler(object):
+    """Keeps the next time every user reaches a channel threshold in a heap, so every
+    notification is enqueued right when it is due"""
+    MAX_WAIT = 60
+
+    def __init__(self, index):
+        self.index = index
+        self.heap = []
+        self.fired = set()
+        self.notifications = defaultdict(int)
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.stopped = False
+
+    def refresh(self, users, now=None):
+        """Replaces scheduled users, `users` are (user_dn, user_data, expiration_time)"""
+        now = datetime.datetime.now() if now is None else now
+        heap = []
+        current = set()
+        for user_dn, user_data, expiration_time in users:
+            current.add((user_dn, expiration_time))
+            if self.index.reached(expiration_time, now):
+                fire_time = now
+            else:
+                fire_time = self.index.next_crossing(expiration_time, now)
+            heap.append((fire_time, next(self.counter), user_dn, user_data, expiration_time))
+        heapq.heapify(heap)
+
+        with self.cond:
+            self.heap = heap
+            # Forget notifications of users removed or whose password changed
+            self.fired = {k for k in self.fired if (k[0], k[2]) in current}
+            self.cond.notify_all()
+        logger.info('Scheduled %d users', len(heap))
+
+    def fire(self, user_dn, user_data, expiration_time, now):
+        for cname, cinfo in self.index.reached(expiration_time, now):
+            key = (user_dn, cname, expiration_time)
+            with self.cond:
+                if key in self.fired:
+                    continue
+                self.fired.add(key)
+            if cinfo.enqueue(expiration_time, user_dn, user_data, now):
+                self.notifications[cname] += 1
+
+        fire_time = self.index.next_crossing(expiration_time, now)
+        if fire_time is not None:
+            with self.cond:
+                heapq.heappush(self.heap,
+                    (fire_time, next(self.counter), user_dn, user_data, expiration_time))
+
+    def run(self):
+        while True:
+            with self.cond:
+                if self.stopped:
+                    break
+                now = datetime.datetime.now()
+                if not self.heap or self.heap[0][0] > now:
+                    timeout = self.MAX_WAIT
+                    if self.heap:
+                        timeout = min(timeout, (self.heap[0][0] - now).total_seconds())
+                    self.cond.wait(timeout)
+                    continue
+                _, _, user_dn, user_data, expiration_time = heapq.heappop(self.heap)
+            self.fire(user_dn, user_data, expiration_time, now)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+
+class Refresher(threading.Thread):
+    """Periodically retrieves users using `fetch` and schedules them, `fetch` receives the
+    time of the next refresh and returns (user_dn, user_data, expiration_time) tuples"""
+
+    def __init__(self, scheduler, fetch, interval):
+        super(Refresher, self).__init__(daemon=True)
+        self.scheduler = scheduler
+        self.fetch = fetch
+        self.interval = interval
+        self.stopped = threading.Event()
+        # This is for informative logging
+        self.name = '{}-{}'.format(self.__class__.__name__, self.name.split('-')[-1])
+
+    def run(self):
+        while not self.stopped.is_set():
+            now = datetime.datetime.now()
+            try:
+                users = list(self.fetch(now + datetime.timedelta(seconds=self.interval)))
+                self.scheduler.refresh(users)
+            except Exception:
+                logger.exception('Unable to refresh users')
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
+from collections.abc import Mapping
+from queue import Queue, Empty, Full
 
 import ldap
+from ldap.ldapobject import ReconnectLDAPObject
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 
 logger = logging.getLogger('ldap-expire-notify')
 
@@ -13,10 +19,40 @@ LDAP_SCOPES = {
 }
 
 
+class LDAPRecord(Mapping):
+    """Read only view of a raw LDAP entry, values are decoded when first accessed"""
+    __slots__ = ('raw', '_decoded')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._decoded = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._decoded[key]
+        except KeyError:
+            values = [v.decode('utf-8') for v in self.raw[key]]
+            self._decoded[key] = values
+            return values
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.raw)
+
+
 class LDAPDatabase(object):
     DEFAULT_ATTRS = ['*', '+']
+    RESULTS_QUEUE_SIZE = 1000
 
-    def __init__(self, host, port, bind_dn, bind_pwd, base_dn):
+    def __init__(self, host, port, bind_dn, bind_pwd, base_dn, retry_max=0):
         if host == 'ldapi:///':
             self.server = host
         elif host.startswith('ldap://') or host.startswith('ldaps://'):
@@ -24,18 +60,24 @@ class LDAPDatabase(object):
         else:
             raise ValueError('Unknown protocol, host must start by one of ldap, ldaps or ldapi')
 
-        logger.debug('Binding to %s@%s', bind_dn, self.server)
-        self.conn = ldap.initialize(self.server)
-        self.conn.simple_bind_s(bind_dn, bind_pwd)
-
+        self.bind_dn = bind_dn
+        self.bind_pwd = bind_pwd
         self.base_dn = base_dn
+        self.retry_max = retry_max
+        self.conn = self.connect()
+
+    def connect(self):
+        logger.debug('Binding to %s@%s', self.bind_dn, self.server)
+        if self.retry_max > 0:
+            conn = ReconnectLDAPObject(self.server, retry_max=self.retry_max)
+        else:
+            conn = ldap.initialize(self.server)
+        conn.simple_bind_s(self.bind_dn, self.bind_pwd)
+        return conn
 
     @staticmethod
     def string_record(record):
-        result = {}
-        for k, v in record.items():
-            result[k] = [vv.decode('utf-8') for vv in v]
-        return result
+        return LDAPRecord(record)
 
     @staticmethod
     def parse_scope(scope):
@@ -44,12 +86,148 @@ class LDAPDatabase(object):
         except KeyError:
             raise ValueError('Unknown LDAP query scope: {}'.format(scope))
 
-    def get_users(self, query='(uid=*)', scope='SUBTREE', attrs=None):
+    @staticmethod
+    def and_query(query, clause):
+        if not query.startswith('('):
+            query = '({})'.format(query)
+        return '(&{query}{clause})'.format(query=query, clause=clause)
+
+    @classmethod
+    def cutoff_query(cls, query, attr, value):
+        return cls.and_query(query, '({attr}<={value})'.format(
+            attr=attr,
+            value=escape_filter_chars(value),
+        ))
+
+    def shard_search(self, shard, query):
+        # Shards are either filters ANDed to the query or sub base DNs
+        if shard.startswith('('):
+            return self.base_dn, self.and_query(query, shard)
+        return shard, query
+
+    def get_users(self, query='(uid=*)', scope='SUBTREE', attrs=None, page_size=0,
+            shards=None, workers=0, prefetch=0):
         logger.debug('Getting users from "%s" using "%s" filter', self.base_dn, query)
         # See https://docs.python-guide.org/writing/gotchas/#mutable-default-arguments to
         # understand the trick with `attrs`
         attrs = self.DEFAULT_ATTRS if attrs is None else attrs
         scope = self.parse_scope(scope)
-        results = self.conn.search_s(self.base_dn, scope, query, attrs)
+        if shards:
+            searches = [self.shard_search(shard, query) for shard in shards]
+            results = self.parallel_search(searches, workers, scope, attrs, page_size, prefetch)
+        elif prefetch > 0:
+            # Entries are fetched by a producer thread while they are being processed
+            results = self.parallel_search([(self.base_dn, query)], 1, scope, attrs, page_size,
+                prefetch, self.conn)
+        else:
+            results = self.search(self.conn, self.base_dn, scope, query, attrs, page_size)
         for dn, entry in results:
             yield dn, self.string_record(entry)
+
+    def search(self, conn, base_dn, scope, query, attrs, page_size=0):
+        if page_size > 0:
+            return self.paged_search(conn, base_dn, scope, query, attrs, page_size)
+        return conn.search_s(base_dn, scope, query, attrs)
+
+    def paged_search(self, conn, base_dn, scope, query, attrs, page_size):
+        # Simple Paged Results control (RFC 2696), entries are yielded as soon as
+        # every page arrives so the full result set is never held in memory
+        control = SimplePagedResultsControl(True, size=page_size, cookie='')
+        pages = 0
+        while True:
+            msgid = conn.search_ext(base_dn, scope, query, attrs, serverctrls=[control])
+            _, data, _, serverctrls = conn.result3(msgid)
+            pages += 1
+            logger.debug('Got page %d with %d entries from "%s"', pages, len(data), base_dn)
+            for dn, entry in data:
+                # Search references are returned with an empty DN
+                if dn:
+                    yield dn, entry
+
+            cookies = [c.cookie for c in serverctrls
+                if c.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                break
+            control.cookie = cookies[0]
+
+    def parallel_search(self, searches, workers, scope, attrs, page_size, queue_size=0,
+            conn=None):
+        # Every worker binds its own connection (unless `conn` is given) and runs pending
+        # searches until there are none left, entries from all of them are merged in
+        # `results`. When it is full workers stop fetching until entries are consumed
+        pending = Queue()
+        for search in searches:
+            pending.put(search)
+        workers = min(workers or len(searches), len(searches))
+        results = Queue(maxsize=queue_size or self.RESULTS_QUEUE_SIZE)
+        stop = threading.Event()
+
+        threads = [
+            SearchWorker(self, pending, results, stop, scope, attrs, page_size, conn)
+            for _ in range(workers)
+        ]
+        logger.debug('Starting %d search workers for %d shards', workers, len(searches))
+        for t in threads:
+            t.start()
+
+        running = len(threads)
+        try:
+            while running:
+                item = results.get()
+                if item is None:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+
+
+class SearchWorker(threading.Thread):
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, database, pending, results, stop, scope, attrs, page_size, conn=None):
+        super(SearchWorker, self).__init__(daemon=True)
+        self.database = database
+        self.pending = pending
+        self.results = results
+        self.stop = stop
+        self.scope = scope
+        self.attrs = attrs
+        self.page_size = page_size
+        self.conn = conn
+        # This is for informative logging
+        self.name = '{}-{}'.format(self.__class__.__name__, self.name.split('-')[-1])
+
+    def put(self, item):
+        # Avoid blocking forever if the consumer is gone
+        while not self.stop.is_set():
+            try:
+                self.results.put(item, timeout=self.POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def run(self):
+        try:
+            conn = self.conn or self.database.connect()
+            while not self.stop.is_set():
+                try:
+                    base_dn, query = self.pending.get_nowait()
+                except Empty:
+                    break
+
+                logger.debug('%s: Searching "%s" using "%s" filter', self.name, base_dn, query)
+                entries = self.database.search(conn, base_dn, self.scope, query, self.attrs,
+                    self.page_size)
+                for entry in entries:
+                    if not self.put(entry):
+                        return
+        except Exception as e:
+            self.put(e)
+        finally:
+            self.put(None)
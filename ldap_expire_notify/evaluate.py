@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import logging
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger('ldap-expire-notify')
+
+
+class ThresholdIndex(object):
+    """Channels sorted by threshold, the ones reached by an expiration time are found
+    using a binary search against a reference time fixed for the whole run"""
+
+    def __init__(self, channels, now=None):
+        self.now = datetime.datetime.now() if now is None else now
+        self.channels = sorted(channels.items(), key=lambda c: c[1].threshold)
+        self.thresholds = [cinfo.threshold for _, cinfo in self.channels]
+
+    def remaining(self, expiration_time, now=None):
+        now = self.now if now is None else now
+        return (expiration_time - now).total_seconds()
+
+    def position(self, expiration_time, now=None):
+        # expiration - threshold < now <=> threshold > expiration - now
+        return bisect.bisect_right(self.thresholds, self.remaining(expiration_time, now))
+
+    def reached(self, expiration_time, now=None):
+        return self.channels[self.position(expiration_time, now):]
+
+    def next_crossing(self, expiration_time, now=None):
+        """Returns the first time when a channel threshold not reached at `now` is reached,
+        or None if all of them were already reached"""
+        position = self.position(expiration_time, now)
+        if position == 0:
+            return None
+        # Thresholds are reached once expiration - threshold is strictly lower than now
+        return expiration_time - datetime.timedelta(
+            seconds=self.thresholds[position - 1], microseconds=-1)
+
+
+def evaluate(batch, index):
+    """Returns a (user, channel name) pair for every channel whose threshold is reached by
+    the users in `batch`, a list of (user_dn, user_data, expiration_time) tuples"""
+    if not batch or not index.channels:
+        return []
+    if numpy is not None:
+        return _evaluate_numpy(batch, index)
+    return _evaluate(batch, index)
+
+
+def _evaluate(batch, index):
+    return [
+        (user, cname)
+        for user in batch
+        for cname, _ in index.reached(user[2])
+    ]
+
+
+def _evaluate_numpy(batch, index):
+    thresholds = numpy.array(index.thresholds, dtype='timedelta64[s]')
+    expirations = numpy.array([user[2] for user in batch], dtype='datetime64[us]')
+    remaining = expirations - numpy.datetime64(index.now, 'us')
+    positions = numpy.searchsorted(thresholds, remaining, side='right')
+    return [
+        (user, cname)
+        for user, position in zip(batch, positions.tolist())
+        for cname, _ in index.channels[position:]
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import datetime
+import sqlite3
+import threading
+
+logger = logging.getLogger('ldap-expire-notify')
+
+
+class StateStore(object):
+    """Keeps track of sent notifications, keyed by user DN, channel and expiration time,
+    so already notified users are skipped by later runs"""
+    DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+    def __init__(self, path):
+        logger.debug('Opening state store at %s', path)
+        # Connection is shared by channel workers, writes are serialized by `lock`
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS notifications (
+                    dn TEXT NOT NULL,
+                    channel TEXT NOT NULL,
+                    expiration TEXT NOT NULL,
+                    sent TEXT NOT NULL,
+                    PRIMARY KEY (dn, channel, expiration)
+                )
+            ''')
+
+    def last_sent(self, user_dn, channel, expiration_time):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT sent FROM notifications WHERE dn = ? AND channel = ? AND expiration = ?',
+                (user_dn, channel, expiration_time.strftime(self.DATE_FORMAT)),
+            ).fetchone()
+        if row is None:
+            return None
+        return datetime.datetime.strptime(row[0], self.DATE_FORMAT)
+
+    def record(self, user_dn, channel, expiration_time, sent=None):
+        sent = datetime.datetime.now() if sent is None else sent
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO notifications (dn, channel, expiration, sent) '
+                'VALUES (?, ?, ?, ?)',
+                (
+                    user_dn,
+                    channel,
+                    expiration_time.strftime(self.DATE_FORMAT),
+                    sent.strftime(self.DATE_FORMAT),
+                ),
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -8,6 +8,8 @@ from . import channel
 
 logger = logging.getLogger('ldap-expire-notify')
 
+GENERALIZED_TIME_FORMAT = '%Y%m%d%H%M%SZ'
+
 
 class MissingModify(ValueError):
     pass
@@ -18,10 +20,19 @@ def die(msg, code=1):
     sys.exit(code)
 
 
-def start_channels(path, smtp_server, smtp_user, smtp_pwd, smtp_ssl, smtp_starttls):
+def start_channels(path, smtp_server, smtp_user, smtp_pwd, smtp_ssl, smtp_starttls,
+        state=None, max_threads=0):
     channels = channel.parse(path)
 
+    # All channels must be registered before any of them starts to share it fairly
+    budget = channel.WorkerBudget(max_threads) if max_threads else None
+    for cname, cinfo in channels.items():
+        cinfo.budget = budget
+        if budget is not None:
+            budget.register(cname)
+
     for cinfo in channels.values():
+        cinfo.state = state
         if isinstance(cinfo, channel.email.EmailChannel):
             cinfo.server = smtp_server
             cinfo.user = smtp_user
@@ -33,12 +44,82 @@ def start_channels(path, smtp_server, smtp_user, smtp_pwd, smtp_ssl, smtp_startt
     return channels
 
 
+def get_channels_attributes(channels, modify_attr):
+    attrs = {modify_attr}
+    for cname, cinfo in channels.items():
+        channel_attrs = cinfo.ldap_attributes()
+        if channel_attrs is None:
+            logger.warning('Channel %s uses the whole LDAP entry, unable to limit attributes',
+                cname)
+            return None
+        attrs.update(channel_attrs)
+
+    return sorted(attrs)
+
+
+def get_notify_cutoff(channels, max_age, now=None):
+    # Users whose password was modified after this time cannot reach any channel threshold
+    now = datetime.datetime.now() if now is None else now
+    threshold = max(cinfo.threshold for cinfo in channels.values())
+    return now - datetime.timedelta(seconds=max_age) + datetime.timedelta(seconds=threshold)
+
+
+def parse_generalized_time(value):
+    """Parses a LDAP GeneralizedTime (YYYYmmddHHMMSS[.fraction](Z|+hhmm|-hhmm)) into a
+    naive UTC datetime, it is way faster than strptime"""
+    if len(value) < 15 or not value[:14].isdigit():
+        raise ValueError('Invalid GeneralizedTime {}'.format(value))
+
+    microsecond = 0
+    tz = value[14:]
+    if tz[0] in '.,':
+        end = 1
+        while end < len(tz) and tz[end].isdigit():
+            end += 1
+        if end == 1:
+            raise ValueError('Invalid GeneralizedTime fraction {}'.format(value))
+        microsecond = int(tz[1:end][:6].ljust(6, '0'))
+        tz = tz[end:]
+
+    if tz == 'Z':
+        offset = 0
+    elif len(tz) == 5 and tz[0] in '+-' and tz[1:].isdigit():
+        offset = int(tz[1:3]) * 60 + int(tz[3:5])
+        offset = offset if tz[0] == '-' else -offset
+    else:
+        raise ValueError('Invalid GeneralizedTime timezone {}'.format(value))
+
+    result = datetime.datetime(
+        int(value[0:4]),
+        int(value[4:6]),
+        int(value[6:8]),
+        int(value[8:10]),
+        int(value[10:12]),
+        int(value[12:14]),
+        microsecond,
+    )
+    return result + datetime.timedelta(minutes=offset) if offset else result
+
+
+def is_modified_after(user_modification, cutoff):
+    # GeneralizedTime in UTC sorts as plain strings, any value with a later second than
+    # `cutoff` (formatted using GENERALIZED_TIME_FORMAT) was modified after it
+    if not user_modification:
+        return False
+    value = user_modification[0]
+    return len(value) >= 15 and value.endswith('Z') and value[:14].isdigit() \
+        and value[:14] > cutoff[:14]
+
+
 def get_user_expiration_time(user_modification, modify_format, max_age):
     if not user_modification:
         raise MissingModify('Modification field is not present')
     try:
         pwd_modification = user_modification[0]
-        modification_time = datetime.datetime.strptime(pwd_modification, modify_format)
+        if modify_format == GENERALIZED_TIME_FORMAT:
+            modification_time = parse_generalized_time(pwd_modification)
+        else:
+            modification_time = datetime.datetime.strptime(pwd_modification, modify_format)
     except ValueError:
         raise MissingModify('Unable to decode password modification time')
 
@@ -46,6 +127,32 @@ def get_user_expiration_time(user_modification, modify_format, max_age):
     return expiration_time
 
 
+def expiring_users(users, modify_field, modify_format, max_age, skip_cutoff=None):
+    """Yields (user_dn, user_data, expiration_time) for every user with a valid modification
+    time, users modified after `skip_cutoff` (see `is_modified_after`) are skipped"""
+    processed = 0
+    for processed, (user_dn, user_data) in enumerate(users, 1):
+        user_modification = user_data.get(modify_field)
+        if skip_cutoff and is_modified_after(user_modification, skip_cutoff):
+            logger.debug('DN=%s can not reach any channel threshold, skipping', user_dn)
+            continue
+
+        try:
+            expiration_time = get_user_expiration_time(
+                user_modification,
+                modify_format,
+                max_age,
+            )
+        except MissingModify as e:
+            logger.error('User DN=%s: %s', user_dn, e)
+            continue
+
+        logger.info('DN=%s password will expire at %s', user_dn, expiration_time)
+        yield user_dn, user_data, expiration_time
+
+    logger.info('Processed %d users', processed)
+
+
 def stop_channels(channels):
     for cname, cinfo in channels.items():
         cinfo.stop()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+import pytest
+
+from ldap_expire_notify import cache
+from ldap_expire_notify.database import LDAPRecord
+
+
+class FakeDatabase(object):
+    base_dn = 'ou=people,o=test'
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.queries = []
+
+    def get_users(self, query, attrs=None, **search):
+        self.queries.append((query, attrs))
+        since = re.search(r'\(modifyTimestamp>=(\w+)\)', query)
+        for dn, entry in sorted(self.entries.items()):
+            if since and entry['modifyTimestamp'][0].decode('utf-8') < since.group(1):
+                continue
+            yield dn, LDAPRecord({} if attrs == ['1.1'] else entry)
+
+
+def user(uid, modified):
+    return {
+        'uid': [uid.encode('utf-8')],
+        'modifyTimestamp': [modified.encode('utf-8')],
+    }
+
+
+@pytest.fixture(scope='function')
+def sync_cache(tmpdir):
+    sync_cache = cache.SyncCache(str(tmpdir.join('cache.db')))
+    yield sync_cache
+    sync_cache.close()
+
+
+def test_encode_decode_entry():
+    entry = {'uid': [b'vcabezas'], 'cn': [b'V\xc3\xadctor'], 'mail': [], 'photo': [b'\x00' * 300]}
+    buf = b'padding' + cache.encode_entry(entry) + cache.encode_entry({})
+
+    decoded, offset = cache.decode_entry(buf, len(b'padding'))
+    assert decoded == entry
+    assert cache.decode_entry(buf, offset) == ({}, len(buf))
+
+
+def test_sync(sync_cache):
+    db = FakeDatabase({
+        'uid=jdoe,ou=people,o=test': user('jdoe', '20190101000000Z'),
+        'uid=vcabezas,ou=people,o=test': user('vcabezas', '20190201000000Z'),
+    })
+
+    users = dict(sync_cache.sync(db, '(uid=*)', ['uid']))
+    assert sorted(users) == ['uid=jdoe,ou=people,o=test', 'uid=vcabezas,ou=people,o=test']
+    assert users['uid=jdoe,ou=people,o=test']['uid'] == ['jdoe']
+    assert db.queries == [('(uid=*)', ['uid', 'modifyTimestamp'])]
+    assert sync_cache.get_meta('high_water_mark') == '20190201000000Z'
+
+    # Only modified users are retrieved, deleted ones are removed
+    db.queries = []
+    db.entries = {
+        'uid=vcabezas,ou=people,o=test': user('vcabezas', '20190301000000Z'),
+        'uid=new,ou=people,o=test': user('new', '20190401000000Z'),
+    }
+    users = dict(sync_cache.sync(db, '(uid=*)', ['uid']))
+    assert sorted(users) == ['uid=new,ou=people,o=test', 'uid=vcabezas,ou=people,o=test']
+    assert users['uid=vcabezas,ou=people,o=test']['modifyTimestamp'] == ['20190301000000Z']
+    assert db.queries == [
+        ('(uid=*)', ['1.1']),
+        ('(&(uid=*)(modifyTimestamp>=20190201000000Z))', ['uid', 'modifyTimestamp']),
+    ]
+    assert sync_cache.get_meta('high_water_mark') == '20190401000000Z'
+
+
+def test_sync_outdated(sync_cache):
+    db = FakeDatabase({
+        'uid=jdoe,ou=people,o=test': user('jdoe', '20190101000000Z'),
+    })
+    list(sync_cache.sync(db, '(uid=*)', ['uid']))
+
+    # Different attributes require a full search
+    db.queries = []
+    users = dict(sync_cache.sync(db, '(uid=*)', ['uid', 'mail']))
+    assert list(users) == ['uid=jdoe,ou=people,o=test']
+    assert db.queries == [('(uid=*)', ['uid', 'mail', 'modifyTimestamp'])]
+
+
+def test_snapshot(tmpdir):
+    path = str(tmpdir.join('users.snapshot'))
+    snapshot = cache.Snapshot(path, 60)
+    entries = [
+        ('uid=jdoe,ou=people,o=test', LDAPRecord(user('jdoe', '20190101000000Z'))),
+        ('uid=vcabezas,ou=people,o=test', LDAPRecord(user('vcabezas', '20190201000000Z'))),
+    ]
+    assert not snapshot.is_valid('signature')
+
+    # Users are yielded while being written
+    assert list(snapshot.write(iter(entries), 'signature')) == entries
+    assert snapshot.is_valid('signature')
+    assert not snapshot.is_valid('other')
+    assert not cache.Snapshot(path, -1).is_valid('signature')
+
+    users = list(snapshot.read())
+    assert users == entries
+    assert all(isinstance(record, LDAPRecord) for _, record in users)
+
+
+def test_snapshot_interrupted(tmpdir):
+    path = str(tmpdir.join('users.snapshot'))
+    snapshot = cache.Snapshot(path, 60)
+
+    def users():
+        yield 'uid=jdoe,ou=people,o=test', LDAPRecord(user('jdoe', '20190101000000Z'))
+        raise RuntimeError('LDAP server gone')
+
+    with pytest.raises(RuntimeError):
+        list(snapshot.write(users(), 'signature'))
+    assert not snapshot.is_valid('signature')
+    assert tmpdir.listdir() == []
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import os
 import time
+import shutil
 import datetime
+import tempfile
 import unittest
 import threading
 import logging
@@ -10,13 +13,28 @@ try:
 except ImportError:
     from StringIO import StringIO
 
-from ldap_expire_notify.channel import base
+from ldap_expire_notify.channel import base, ratelimit
+from ldap_expire_notify import state
 
 
 class TestChannelWorkerCls(base.ChannelWorker):
     def __init__(self, *args, **kwargs):
         super(TestChannelWorkerCls, self).__init__(*args, **kwargs)
 
+    def notify(self, task):
+        pass
+
+
+class ThrottledWorkerCls(base.ChannelWorker):
+    def notify(self, task):
+        if task.get('attempts', 0) < 2:
+            raise ratelimit.Throttled(0.1)
+
+
+class SlowWorkerCls(base.ChannelWorker):
+    def notify(self, task):
+        time.sleep(0.05)
+
 
 class TestChannelCls(base.Channel):
     def new_worker(self):
@@ -53,6 +71,69 @@ class TestChannel(unittest.TestCase):
         self.assertEqual(task['dn'], 'uid=test')
         self.assertEqual(task['ldap'], {'trigger': True})
 
+    def test_ldap_attributes(self):
+        self.assertEqual(base.ldap_attributes('{{ dn }}'), set())
+        self.assertEqual(
+            base.ldap_attributes("{{ ldap.mail | first }} {{ ldap['cn'][0] }} {{ ldap.mail }}"),
+            {'mail', 'cn'},
+        )
+        self.assertIsNone(base.ldap_attributes('{{ ldap }}'))
+        self.assertIsNone(base.ldap_attributes('{% for k in ldap %}{{ k }}{% endfor %}'))
+        self.assertIsNone(base.ldap_attributes('{{ ldap[dn] }}'))
+        self.assertEqual(base.ldap_attributes(
+            "{% for t in tasks %}{{ t.ldap.uid | first }} {{ t['ldap'].mail }}{% endfor %}"
+        ), {'uid', 'mail'})
+        self.assertIsNone(base.ldap_attributes('{% for t in tasks %}{{ t.ldap }}{% endfor %}'))
+
+        self.c.template('{{ ldap.uid | first }}')
+        self.c.template('{{ ldap.mail | first }}')
+        self.assertEqual(self.c.ldap_attributes(), {'uid', 'mail'})
+
+        self.c.template('{{ ldap | tojson }}')
+        self.assertIsNone(self.c.ldap_attributes())
+
+    def test_queue_size(self):
+        self.assertEqual(self.c.queue.maxsize, 0)
+
+        c = TestChannelCls('bounded', {'threshold': 10, 'queue_size': 1})
+        self.assertEqual(c.queue.maxsize, 1)
+        expiration = datetime.datetime.now()
+        self.assertTrue(c.check_and_notify(expiration, 'uid=test', {}))
+        self.assertTrue(c.queue.full())
+
+    def test_already_notified(self):
+        self.c.state = state.StateStore(':memory:')
+        now = datetime.datetime.now()
+        expiration = now - datetime.timedelta(seconds=self.c.threshold + 1)
+
+        self.c.start()
+        self.assertTrue(self.c.check_and_notify(expiration, 'uid=test', {}, now))
+        self.c.queue.join()
+        self.assertIsNotNone(self.c.state.last_sent('uid=test', 'test', expiration))
+        self.assertFalse(self.c.check_and_notify(expiration, 'uid=test', {}, now))
+
+        # Notification is sent again after renotify seconds
+        self.c.renotify = 3600
+        self.assertFalse(self.c.enqueue(expiration, 'uid=test', {}, now))
+        later = now + datetime.timedelta(seconds=3601)
+        self.assertTrue(self.c.enqueue(expiration, 'uid=test', {}, later))
+
+    def test_template(self):
+        t = self.c.template('{{ dn }}')
+        self.assertEqual(t.render(dn='uid=test'), 'uid=test')
+        self.assertIs(self.c.template('{{ dn }}'), t)
+        self.assertEqual(self.c.templates, ['{{ dn }}', '{{ dn }}'])
+
+    def test_template_cache(self):
+        cache_dir = os.path.join(tempfile.mkdtemp(), 'templates')
+        try:
+            base.configure_templates(cache_dir)
+            self.c.template('{{ dn }} cached')
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+        finally:
+            base.configure_templates(None)
+            shutil.rmtree(os.path.dirname(cache_dir))
+
     def test_check_configuration(self):
         with self.assertRaisesRegex(ValueError, '^Required field \w+ is missing'):
             self.c.check_configuration({})
@@ -72,3 +153,102 @@ class TestChannel(unittest.TestCase):
 
         self.c.queue.join()
         self.assertRegex(self.buf.getvalue(), r'\bUnable to notify task False\b')
+
+    def test_rate(self):
+        self.assertIsNone(self.c.limiter)
+        self.assertEqual(self.c.reserve(), 0)
+
+        c = TestChannelCls('limited', {'threshold': 10, 'rate': 2, 'burst': 3})
+        self.assertEqual(c.limiter.rate, 2)
+        self.assertEqual(c.limiter.burst, 3)
+        with self.assertRaisesRegex(ValueError, '^rate must be greater than 0, got 0'):
+            TestChannelCls('limited', {'threshold': 10, 'rate': 0})
+        with self.assertRaisesRegex(ValueError, '^burst must be greater than 0, got 0'):
+            TestChannelCls('limited', {'threshold': 10, 'rate': 1, 'burst': 0})
+
+    def test_retry(self):
+        notified = []
+        self.c.new_worker = lambda: ThrottledWorkerCls(self.c, self.c.queue)
+        self.c.notified = notified.append
+        self.c.start()
+        self.c.enqueue(datetime.datetime.now(), 'uid=test', {})
+        # Stopping waits for pending retries
+        self.c.stop()
+        self.assertEqual(len(notified), 1)
+        self.assertEqual(notified[0]['attempts'], 2)
+
+    def test_workers_range(self):
+        self.assertFalse(self.c.autoscale)
+        c = TestChannelCls('scaled', {'threshold': 10, 'min_workers': 0, 'max_workers': 5})
+        self.assertTrue(c.autoscale)
+        with self.assertRaisesRegex(ValueError, '^Invalid workers range 3-2'):
+            TestChannelCls('scaled', {'threshold': 10, 'min_workers': 3, 'max_workers': 2})
+        with self.assertRaisesRegex(ValueError, '^Invalid workers range 0-0'):
+            TestChannelCls('scaled', {'threshold': 10, 'workers': 0})
+
+    def test_autoscale(self):
+        self.c = TestChannelCls('scaled', {
+            'threshold': 10,
+            'min_workers': 0,
+            'max_workers': 4,
+            'idle_timeout': 0.2,
+        })
+        self.c.new_worker = lambda: SlowWorkerCls(self.c, self.c.queue)
+        self.c.start()
+        self.assertEqual(len(self.c.workers), 0)
+
+        for i in range(40):
+            self.c.enqueue(datetime.datetime.now(), 'uid=test{}'.format(i), {})
+        self.assertGreater(len(self.c.workers), 1)
+        self.assertLessEqual(len(self.c.workers), 4)
+        self.c.queue.join()
+        self.assertAlmostEqual(self.c.latency, 0.05, delta=0.04)
+
+        # Idle workers exit
+        time.sleep(0.5)
+        self.assertEqual(len(self.c.workers), 0)
+        self.c.enqueue(datetime.datetime.now(), 'uid=late', {})
+        self.assertEqual(len(self.c.workers), 1)
+
+    def test_worker_budget(self):
+        budget = base.WorkerBudget(4)
+        budget.register('a')
+        budget.register('b')
+        self.assertEqual(budget.fair_share(), 2)
+        # Channels grow over their share while nobody else waits
+        self.assertTrue(all(budget.acquire('a') for _ in range(4)))
+        self.assertFalse(budget.acquire('b'))
+        self.assertTrue(budget.contended('a'))
+
+        budget.release('a')
+        self.assertFalse(budget.acquire('a'))
+        self.assertTrue(budget.acquire('b'))
+        self.assertFalse(budget.contended('a'))
+        self.assertTrue(budget.acquire('b', force=True))
+        self.assertEqual(budget.used, 5)
+
+    def test_worker_budget_channels(self):
+        budget = base.WorkerBudget(3)
+        channels = []
+        for name in ('a', 'b'):
+            c = TestChannelCls(name, {
+                'threshold': 10,
+                'min_workers': 1,
+                'max_workers': 10,
+                'idle_timeout': 0.2,
+            })
+            c.new_worker = (lambda c: lambda: SlowWorkerCls(c, c.queue))(c)
+            c.budget = budget
+            budget.register(name)
+            channels.append(c)
+        for c in channels:
+            c.start()
+        try:
+            for i in range(40):
+                for c in channels:
+                    c.enqueue(datetime.datetime.now(), 'uid=test{}'.format(i), {})
+                self.assertLessEqual(budget.used, 3)
+        finally:
+            for c in channels:
+                c.stop()
+        self.assertEqual(budget.used, 0)
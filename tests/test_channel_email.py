@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import re
 import time
+import smtplib
 import datetime
 import unittest
-from mock import patch, call, ANY
+from mock import patch, call, ANY, MagicMock
 
 from ldap_expire_notify.channel import email
 
@@ -43,6 +44,10 @@ class TestEmailChannel(unittest.TestCase):
         for w in self.c.workers:
             self.assertIsInstance(w, email.EmailWorker)
             self.assertEqual(w.channel, self.c)
+            self.assertEqual(w.pool, self.c.pool)
+
+        # Connections are only opened when needed
+        self.assertFalse(smtp_mock.called)
 
     @patch("smtplib.SMTP")
     def test_worker_notify(self, smtp_mock):
@@ -69,3 +74,96 @@ class TestEmailChannel(unittest.TestCase):
         self.assertEqual(instance.sendmail.mock_calls,
             [call(msg_data['ldap']['mail'][0], [msg_data['ldap']['mail'][0]], ANY)],
         )
+
+    @patch("smtplib.SMTP")
+    def test_worker_notify_body_text(self, smtp_mock):
+        c = email.EmailChannel('test-text', {
+            'threshold': 10,
+            'workers': 1,
+            'subject': 'password expiring',
+            'recipient': '{{ ldap.mail | first}}',
+            'from': '{{ ldap.mail | first}}',
+            'body': '<p>{{ dn }}</p>',
+            'body_text': 'Plain {{ dn }}',
+        })
+        c.server = 'smtp.test.com'
+        c.start()
+        try:
+            c.workers[0].notify({
+                'dn': 'uid=vcabezas,ou=people,o=test',
+                'expiration': datetime.datetime.now(),
+                'ldap': {'mail': ['vcabezas@example.com']},
+            })
+        finally:
+            c.stop()
+
+        msg = smtp_mock.return_value.sendmail.call_args[0][2]
+        self.assertIn('Plain uid=vcabezas,ou=people,o=test', msg)
+        self.assertIn('<p>uid=vcabezas,ou=people,o=test</p>', msg)
+
+    def test_html_to_text(self):
+        self.assertEqual(email.html_to_text(
+            '<html><head><style>p { color: red; }</style></head>'
+            '<body><h3>Hi &amp; bye</h3><p>Your password <b>expires</b></p>'
+            '<script>alert(1)</script></body></html>'
+        ), 'Hi & byeYour password expires')
+        self.assertEqual(email.html_to_text('plain text'), 'plain text')
+
+
+@patch("smtplib.SMTP")
+class TestSMTPPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = email.SMTPPool('smtp.test.com:2525', 'user', 'pwd', False, True, 2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_connect(self, smtp_mock):
+        self.pool.sendmail('from@test.com', ['to@test.com'], 'msg')
+        smtp_mock.assert_called_once_with('smtp.test.com', 2525)
+        instance = smtp_mock.return_value
+        self.assertEqual(instance.mock_calls[:3], [
+            call.starttls(),
+            call.ehlo(),
+            call.login('user', 'pwd'),
+        ])
+
+    def test_reuse(self, smtp_mock):
+        self.pool.sendmail('from@test.com', ['to@test.com'], 'msg')
+        self.pool.sendmail('from@test.com', ['to@test.com'], 'msg')
+        self.assertEqual(smtp_mock.call_count, 1)
+        self.assertEqual(smtp_mock.return_value.sendmail.call_count, 2)
+
+        # Connection is recycled after max_messages
+        self.assertEqual(self.pool.idle, [])
+        self.pool.sendmail('from@test.com', ['to@test.com'], 'msg')
+        self.assertEqual(smtp_mock.call_count, 2)
+
+    def test_reconnect(self, smtp_mock):
+        dropped = MagicMock()
+        dropped.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        smtp_mock.side_effect = [dropped, MagicMock()]
+
+        self.pool.sendmail('from@test.com', ['to@test.com'], 'msg')
+        self.assertEqual(smtp_mock.call_count, 2)
+        self.assertEqual(len(self.pool.idle), 1)
+        self.assertIsNot(self.pool.idle[0].conn, dropped)
+
+    def test_reconnect_ko(self, smtp_mock):
+        smtp_mock.return_value.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.pool.sendmail('from@test.com', ['to@test.com'], 'msg')
+        self.assertEqual(smtp_mock.call_count, 2)
+        self.assertEqual(self.pool.idle, [])
+
+    def test_idle_check(self, smtp_mock):
+        self.pool.sendmail('from@test.com', ['to@test.com'], 'msg')
+        stale = self.pool.idle[0]
+        stale.last_used -= self.pool.IDLE_CHECK + 1
+        stale.conn.noop.side_effect = smtplib.SMTPServerDisconnected()
+        smtp_mock.return_value = MagicMock()
+
+        self.pool.sendmail('from@test.com', ['to@test.com'], 'msg')
+        self.assertEqual(smtp_mock.call_count, 2)
+        self.assertIsNot(self.pool.idle[0], stale)
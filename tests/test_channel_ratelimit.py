@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+import threading
+from queue import Queue
+
+from ldap_expire_notify.channel import ratelimit
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_reserve(self):
+        bucket = ratelimit.TokenBucket(10, burst=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.01)
+        # Waits add up for callers without a token
+        self.assertAlmostEqual(bucket.reserve(), 0.2, delta=0.01)
+
+    def test_refill(self):
+        bucket = ratelimit.TokenBucket(100, burst=1)
+        self.assertEqual(bucket.reserve(), 0)
+        time.sleep(0.05)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertGreater(bucket.reserve(), 0)
+
+    def test_acquire_threads(self):
+        bucket = ratelimit.TokenBucket(50, burst=1)
+        threads = [threading.Thread(target=bucket.acquire) for _ in range(10)]
+        was = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreaterEqual(time.monotonic() - was, 9 / 50 - 0.01)
+
+
+class TestRetryScheduler(unittest.TestCase):
+    def setUp(self):
+        self.queue = Queue()
+        self.retries = ratelimit.RetryScheduler(self.queue.put)
+        self.retries.start()
+
+    def tearDown(self):
+        self.retries.stop()
+        self.retries.join()
+
+    def test_schedule(self):
+        was = time.monotonic()
+        self.retries.schedule('late', 0.2)
+        self.retries.schedule('early', 0.1)
+        self.assertEqual(self.retries.pending(), 2)
+
+        self.assertEqual(self.queue.get(timeout=1), 'early')
+        self.assertEqual(self.queue.get(timeout=1), 'late')
+        self.assertGreaterEqual(time.monotonic() - was, 0.2)
+
+    def test_wait_idle(self):
+        self.assertFalse(self.retries.wait_idle())
+        self.retries.schedule('task', 0.1)
+        self.assertTrue(self.retries.wait_idle())
+        self.assertEqual(self.retries.pending(), 0)
+        self.assertEqual(self.queue.get_nowait(), 'task')
+
+    def test_stop(self):
+        self.retries.schedule('task', 10)
+        self.retries.stop()
+        self.retries.join(timeout=1)
+        self.assertFalse(self.retries.is_alive())
+        self.assertTrue(self.queue.empty())
@@ -4,6 +4,8 @@ import datetime
 import unittest
 import threading
 import requests_mock
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from ldap_expire_notify.channel import webhook
 
@@ -15,6 +17,38 @@ def mock_request_matcher(request):
             request.path_url == '/vcabezas'
 
 
+class RecordingServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        super(RecordingServer, self).__init__(('127.0.0.1', 0), RecordingHandler)
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(0.1)
+        with server.lock:
+            server.in_flight -= 1
+            server.requests.append((self.path, body))
+        self.send_response(server.status_code)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    def log_message(self, *args):
+        pass
+
+
 @requests_mock.Mocker()
 class TestWebhookChannel(unittest.TestCase):
     def setUp(self):
@@ -71,6 +105,21 @@ class TestWebhookChannel(unittest.TestCase):
             self.assertEqual(w.channel, self.c)
             self.assertEqual(w.channel.throttle_code, self.c.throttle_code)
             self.assertEqual(w.channel.throttle_retries, self.c.throttle_retries)
+            self.assertIs(w.session, self.c.session)
+
+    def test_session_pool(self):
+        self.assertEqual(self.c.pool_size, 1)
+        self.c.start()
+        adapter = self.c.session.get_adapter('https://test.com/')
+        self.assertEqual(adapter._pool_maxsize, 1)
+        self.assertIs(adapter, self.c.session.get_adapter('http://test.com/'))
+
+        with self.assertRaisesRegex(ValueError, '^pool_size must be greater than 0, got 0'):
+            webhook.WebhookChannel('webhook-test', {
+                'threshold': 1,
+                'pool_size': 0,
+                'url': 'http://test.com/{{ ldap.uid | first }}',
+            })
 
     def test_worker_notify(self, req_mock):
         req_mock.post(
@@ -90,6 +139,86 @@ class TestWebhookChannel(unittest.TestCase):
 
         self.assertEqual(req_mock.call_count, 1)
 
+    def test_worker_notify_keepalive(self, req_mock):
+        req_mock.post('http://test.com/vcabezas', text='OK')
+        self.c.start()
+        w = self.c.workers[0]
+        for i in range(3):
+            w.notify({
+                'dn': 'uid=vcabezas,ou=people,o=test',
+                'expiration': datetime.datetime.now(),
+                'ldap': {
+                    'uid': ['vcabezas'],
+                },
+            })
+
+        self.assertEqual(req_mock.call_count, 3)
+        self.assertTrue(all(
+            r.headers.get('Connection') == 'keep-alive' for r in req_mock.request_history
+        ))
+
+    def batch_channel(self):
+        return webhook.WebhookChannel('test-batch', {
+            'threshold': 10,
+            'workers': 1,
+            'batch_size': 3,
+            'batch_max_wait': 0.2,
+            'url': 'http://test.com/batch',
+            'method': 'post',
+            'batch_body': '{% for t in tasks %}{{ t.ldap.uid | first }} {% endfor %}{{ threshold }}',
+        })
+
+    def test_worker_batch(self, req_mock):
+        req_mock.post('http://test.com/batch', text='OK')
+        c = self.batch_channel()
+        self.assertEqual(c.ldap_attributes(), {'uid'})
+        c.start()
+        self.assertIsInstance(c.workers[0], webhook.BatchWebhookWorker)
+        for i in range(7):
+            c.enqueue(datetime.datetime.now(), 'uid=user{}'.format(i), {
+                'uid': ['user{}'.format(i)],
+            })
+        c.stop()
+
+        self.assertEqual([r.text for r in req_mock.request_history], [
+            'user0 user1 user2 10',
+            'user3 user4 user5 10',
+            'user6 10',
+        ])
+
+    def test_worker_batch_max_wait(self, req_mock):
+        req_mock.post('http://test.com/batch', text='OK')
+        c = self.batch_channel()
+        c.start()
+        try:
+            c.enqueue(datetime.datetime.now(), 'uid=user0', {'uid': ['user0']})
+            time.sleep(0.5)
+            self.assertEqual(req_mock.call_count, 1)
+            self.assertEqual(req_mock.last_request.text, 'user0 10')
+        finally:
+            c.stop()
+
+    def test_batch_init_ko(self):
+        with self.assertRaisesRegex(ValueError, '^batch_body is required'):
+            webhook.WebhookChannel('webhook-test', {
+                'threshold': 1,
+                'batch_size': 10,
+                'url': 'http://test.com/',
+            })
+
+        with self.assertRaisesRegex(ValueError, '^batch_max_wait must be greater than 0, got 0'):
+            webhook.WebhookChannel('webhook-test', {
+                'threshold': 1,
+                'batch_size': 10,
+                'batch_max_wait': 0,
+                'batch_body': '{{ tasks | length }}',
+                'url': 'http://test.com/',
+            })
+
+    def enqueue_vcabezas(self):
+        self.c.enqueue(datetime.datetime.now(), 'uid=vcabezas,ou=people,o=test', {
+            'uid': ['vcabezas'],
+        })
 
     def test_worker_notify_throttle(self, req_mock):
         req_mock.post(
@@ -99,21 +228,19 @@ class TestWebhookChannel(unittest.TestCase):
             status_code=444,
             reason='Rate limited',
         )
+        notified = []
+        self.c.notified = notified.append
 
         self.c.start()
-        w = self.c.workers[0]
         was = datetime.datetime.now()
-        with self.assertRaises(RuntimeError):
-            w.notify({
-                'dn': 'uid=vcabezas,ou=people,o=test',
-                'expiration': datetime.datetime.now(),
-                'ldap': {
-                    'uid': ['vcabezas'],
-                },
-            })
+        self.enqueue_vcabezas()
+        self.c.stop()
         now = datetime.datetime.now()
-        self.assertEqual(req_mock.call_count, w.throttle_retries)
-        self.assertGreaterEqual(now - was, datetime.timedelta(seconds=6))
+
+        self.assertEqual(req_mock.call_count, self.c.throttle_retries)
+        self.assertEqual(notified, [])
+        # Backoff of 1 and 2 seconds between the 3 attempts
+        self.assertGreaterEqual(now - was, datetime.timedelta(seconds=3))
 
     def test_worker_notify_max_sleep(self, req_mock):
         req_mock.post(
@@ -124,20 +251,154 @@ class TestWebhookChannel(unittest.TestCase):
             reason='Rate limited',
         )
 
+        self.c.throttle_retries = 5
+        self.c.throttle_max_sleep = 1
         self.c.start()
-        w = self.c.workers[0]
-        w.throttle_retries = 5
-        w.throttle_max_sleep = 1
         was = datetime.datetime.now()
-        with self.assertRaises(RuntimeError):
-            w.notify({
-                'dn': 'uid=vcabezas,ou=people,o=test',
-                'expiration': datetime.datetime.now(),
-                'ldap': {
-                    'uid': ['vcabezas'],
-                },
-            })
+        self.enqueue_vcabezas()
+        self.c.stop()
         now = datetime.datetime.now()
-        self.assertEqual(req_mock.call_count, w.throttle_retries)
-        self.assertGreaterEqual(now - was, datetime.timedelta(seconds=5))
+
+        self.assertEqual(req_mock.call_count, 5)
+        self.assertGreaterEqual(now - was, datetime.timedelta(seconds=4))
         self.assertLessEqual(now - was, datetime.timedelta(seconds=15))
+
+    def test_worker_notify_retry_after(self, req_mock):
+        req_mock.post('http://test.com/vcabezas', [
+            {'status_code': 444, 'headers': {'Retry-After': '0'}},
+            {'status_code': 444, 'headers': {'Retry-After': '0'}},
+            {'status_code': 200, 'text': 'OK'},
+        ])
+        notified = []
+        self.c.notified = notified.append
+
+        self.c.start()
+        was = datetime.datetime.now()
+        self.enqueue_vcabezas()
+        self.c.stop()
+        now = datetime.datetime.now()
+
+        self.assertEqual(req_mock.call_count, 3)
+        self.assertEqual(len(notified), 1)
+        self.assertEqual(notified[0]['attempts'], 2)
+        self.assertLess(now - was, datetime.timedelta(seconds=1))
+
+    def test_worker_retry_releases_worker(self, req_mock):
+        req_mock.post('http://test.com/throttled', status_code=444)
+        req_mock.post('http://test.com/other', text='OK')
+        self.c.start()
+        self.c.enqueue(datetime.datetime.now(), 'uid=throttled', {'uid': ['throttled']})
+        time.sleep(0.1)
+        # The only worker is free while the throttled task waits for its retry
+        self.c.enqueue(datetime.datetime.now(), 'uid=other', {'uid': ['other']})
+        time.sleep(0.1)
+        self.assertEqual([r.path for r in req_mock.request_history], ['/throttled', '/other'])
+        self.c.stop()
+
+    def test_worker_rate(self, req_mock):
+        req_mock.post('http://test.com/vcabezas', text='OK')
+        self.c = webhook.WebhookChannel('test-rate', {
+            'threshold': 10,
+            'workers': 4,
+            'rate': 20,
+            'burst': 2,
+            'url': 'http://test.com/{{ ldap.uid | first }}',
+            'method': 'post',
+        })
+        self.c.start()
+        was = time.monotonic()
+        for i in range(12):
+            self.enqueue_vcabezas()
+        self.c.stop()
+
+        self.assertEqual(req_mock.call_count, 12)
+        # 2 sent as a burst, the rest spaced by 1/20 seconds
+        self.assertGreaterEqual(time.monotonic() - was, 0.45)
+
+    def test_backoff(self):
+        self.c.throttle_max_sleep = 10
+        self.c.start()
+        w = self.c.workers[0]
+        self.assertEqual([w.backoff(i) for i in range(1, 6)], [1, 2, 4, 8, 10])
+        self.assertEqual(w.backoff(1, '120'), 120)
+        self.assertEqual(w.backoff(1, 'Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=60)
+        self.assertAlmostEqual(
+            w.backoff(1, later.strftime('%a, %d %b %Y %H:%M:%S GMT')), 60, delta=2)
+        self.assertEqual(w.backoff(3, 'soon'), 4)
+
+
+@unittest.skipIf(webhook.aiohttp is None, 'aiohttp is not installed')
+class TestAsyncWebhookChannel(unittest.TestCase):
+    def setUp(self):
+        self.server = RecordingServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.c = webhook.WebhookChannel('test-async', {
+            'threshold': 10,
+            'engine': 'async',
+            'concurrency': 5,
+            'throttle_code': 444,
+            'throttle_retries': 3,
+            'throttle_max_sleep': 1,
+            'url': 'http://127.0.0.1:{}/{{{{ ldap.uid | first }}}}'.format(
+                self.server.server_address[1]),
+            'method': 'post',
+            'body': '{{ dn }}',
+        })
+
+    def tearDown(self):
+        self.c.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def enqueue(self, count):
+        now = datetime.datetime.now()
+        for i in range(count):
+            self.c.enqueue(now, 'uid=user{},ou=people,o=test'.format(i), {
+                'uid': ['user{}'.format(i)],
+            })
+
+    def test_init(self):
+        self.assertEqual(self.c.num_workers, 1)
+        with self.assertRaisesRegex(ValueError, '^engine must be one of threads, async, got foo'):
+            webhook.WebhookChannel('webhook-test', {
+                'threshold': 1,
+                'engine': 'foo',
+                'url': 'http://test.com/',
+            })
+
+        with self.assertRaisesRegex(ValueError, '^concurrency must be greater than 0, got 0'):
+            webhook.WebhookChannel('webhook-test', {
+                'threshold': 1,
+                'engine': 'async',
+                'concurrency': 0,
+                'url': 'http://test.com/',
+            })
+
+    def test_notify(self):
+        self.c.start()
+        self.assertEqual(len(self.c.workers), 1)
+        self.assertIsInstance(self.c.workers[0], webhook.AsyncWebhookWorker)
+        self.enqueue(20)
+        self.c.stop()
+
+        self.assertEqual(sorted(self.server.requests), sorted(
+            ('/user{}'.format(i), 'uid=user{},ou=people,o=test'.format(i)) for i in range(20)
+        ))
+        self.assertGreater(self.server.max_in_flight, 1)
+        self.assertLessEqual(self.server.max_in_flight, 5)
+
+    def test_notify_throttle(self):
+        self.server.status_code = 444
+        self.c.start()
+        was = datetime.datetime.now()
+        self.enqueue(5)
+        self.c.stop()
+        now = datetime.datetime.now()
+
+        self.assertEqual(len(self.server.requests), 5 * self.c.throttle_retries)
+        # Backoffs of every task overlap instead of running one after another
+        self.assertGreaterEqual(now - was, datetime.timedelta(seconds=2))
+        self.assertLess(now - was, datetime.timedelta(seconds=5))
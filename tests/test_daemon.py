@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+
+import pytest
+
+from ldap_expire_notify import daemon
+from ldap_expire_notify import evaluate
+from ldap_expire_notify.channel import base
+
+
+class TestChannelCls(base.Channel):
+    def new_worker(self):
+        return base.ChannelWorker(self, self.queue)
+
+
+@pytest.fixture(scope='function')
+def scheduler():
+    channels = {
+        'hour': TestChannelCls('hour', {'threshold': 3600}),
+        'day': TestChannelCls('day', {'threshold': 86400}),
+    }
+    return daemon.Scheduler(evaluate.ThresholdIndex(channels))
+
+
+def _queued(scheduler):
+    queued = []
+    for cname, cinfo in scheduler.index.channels:
+        while not cinfo.queue.empty():
+            queued.append((cinfo.queue.get()['dn'], cname))
+    return sorted(queued)
+
+
+def test_refresh(scheduler):
+    now = datetime.datetime(2019, 6, 10)
+    expiration = now + datetime.timedelta(days=2)
+    scheduler.refresh([
+        ('uid=due', {}, now),
+        ('uid=later', {}, expiration),
+        ('uid=done', {}, now - datetime.timedelta(days=2)),
+    ], now)
+
+    assert sorted((t, dn) for t, _, dn, _, _ in scheduler.heap) == [
+        (now, 'uid=done'),
+        (now, 'uid=due'),
+        (expiration - datetime.timedelta(seconds=86400, microseconds=-1), 'uid=later'),
+    ]
+
+
+def test_fire(scheduler):
+    now = datetime.datetime(2019, 6, 10)
+    expiration = now + datetime.timedelta(hours=12)
+    scheduler.refresh([('uid=later', {}, expiration)], now)
+
+    # Day threshold is reached, hour one is scheduled next
+    day = expiration - datetime.timedelta(days=1, microseconds=-1)
+    scheduler.fire('uid=later', {}, expiration, day)
+    assert _queued(scheduler) == [('uid=later', 'day')]
+    assert scheduler.heap[-1][0] == expiration - datetime.timedelta(hours=1, microseconds=-1)
+
+    # Already fired notifications are not enqueued again
+    hour = expiration - datetime.timedelta(hours=1, microseconds=-1)
+    scheduler.fire('uid=later', {}, expiration, hour)
+    assert _queued(scheduler) == [('uid=later', 'hour')]
+    assert dict(scheduler.notifications) == {'day': 1, 'hour': 1}
+
+    # Refreshing keeps fired notifications unless password changed
+    scheduler.refresh([('uid=later', {}, expiration)], hour)
+    assert len(scheduler.fired) == 2
+    scheduler.refresh([('uid=later', {}, expiration + datetime.timedelta(days=30))], hour)
+    assert len(scheduler.fired) == 0
+
+
+def test_run(scheduler):
+    now = datetime.datetime.now()
+    scheduler.refresh([('uid=due', {}, now)], now)
+
+    t = threading.Thread(target=scheduler.run)
+    t.start()
+    cinfo = dict(scheduler.index.channels)['hour']
+    task = cinfo.queue.get(timeout=5)
+    scheduler.stop()
+    t.join(timeout=5)
+
+    assert task['dn'] == 'uid=due'
+    assert not t.is_alive()
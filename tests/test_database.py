@@ -3,7 +3,10 @@ import unittest
 import os
 import yaml
 import mockldap
+import jinja2
 import ldap
+from ldap.controls import SimplePagedResultsControl
+from mock import MagicMock
 
 from ldap_expire_notify import database
 
@@ -65,6 +68,32 @@ class TestLDAPDatabase(unittest.TestCase):
 
         self.assertEqual(database.LDAPDatabase.string_record(a), b)
 
+    def test_ldap_record(self):
+        raw = {'uid': [b'vcabezas'], 'cn': [b'V\xc3\xadctor']}
+        r = database.LDAPRecord(raw)
+
+        self.assertEqual(len(r), 2)
+        self.assertIn('uid', r)
+        self.assertNotIn('mail', r)
+        self.assertIsNone(r.get('mail'))
+        self.assertEqual(r['cn'], ['V\xedctor'])
+        self.assertIs(r['cn'], r['cn'])
+        self.assertEqual(dict(r), {'uid': ['vcabezas'], 'cn': ['V\xedctor']})
+        self.assertFalse(hasattr(r, '__dict__'))
+
+        tmpl = jinja2.Template('{{ ldap.uid | first }} {{ ldap.mail | default("none") }}')
+        self.assertEqual(tmpl.render(ldap=r), 'vcabezas none')
+
+    def test_cutoff_query(self):
+        self.assertEqual(
+            database.LDAPDatabase.cutoff_query('(uid=*)', 'pwdChangedTime', '20190101000000Z'),
+            '(&(uid=*)(pwdChangedTime<=20190101000000Z))',
+        )
+        self.assertEqual(
+            database.LDAPDatabase.cutoff_query('uid=*', 'pwdChangedTime', '2019*'),
+            '(&(uid=*)(pwdChangedTime<=2019\\2a))',
+        )
+
     def test_parse_scope(self):
         self.assertEqual(database.LDAPDatabase.parse_scope('SUBTREE'), ldap.SCOPE_SUBTREE)
         self.assertEqual(database.LDAPDatabase.parse_scope('ONELEVEL'), ldap.SCOPE_ONELEVEL)
@@ -86,3 +115,87 @@ class TestLDAPDatabase(unittest.TestCase):
         self.assertEqual(len(users), len([1 for u in test_directory if 'uid=' in u]))
 
         self.assertEqual(self.ldapobj.methods_called(), ['initialize', 'simple_bind_s', 'search_s'])
+
+    def test_get_users_paged(self):
+        m = database.LDAPDatabase(
+            'ldap://localhost',
+            389,
+            'uid=binduser,ou=people,o=test',
+            'bindpwd',
+            'ou=people,o=test',
+        )
+
+        def page(cookie):
+            return SimplePagedResultsControl(True, size=1, cookie=cookie)
+
+        m.conn = MagicMock()
+        m.conn.result3.side_effect = [
+            (None, [('uid=jdoe,ou=people,o=test', {'uid': [b'jdoe']})], None, [page(b'next')]),
+            (None, [('uid=vcabezas,ou=people,o=test', {'uid': [b'vcabezas']}),
+                (None, ['ldap://referral/'])], None, [page(b'')]),
+        ]
+
+        users = {dn: data for dn, data in m.get_users('(uid=*)', page_size=1)}
+        self.assertEqual(users, {
+            'uid=jdoe,ou=people,o=test': {'uid': ['jdoe']},
+            'uid=vcabezas,ou=people,o=test': {'uid': ['vcabezas']},
+        })
+        self.assertEqual(m.conn.search_ext.call_count, 2)
+        self.assertFalse(m.conn.search_s.called)
+
+    def test_get_users_sharded(self):
+        m = database.LDAPDatabase(
+            'ldap://localhost',
+            389,
+            'uid=binduser,ou=people,o=test',
+            'bindpwd',
+            'ou=people,o=test',
+        )
+
+        users = [dn for dn, data in m.get_users('(uid=*)', shards=['(uid=j*)', '(uid=v*)'])]
+        self.assertEqual(sorted(users), [
+            'uid=jdoe,ou=people,o=test',
+            'uid=vcabezas,ou=people,o=test',
+        ])
+        self.assertEqual(self.ldapobj.methods_called().count('search_s'), 2)
+
+    def test_get_users_sharded_error(self):
+        m = database.LDAPDatabase(
+            'ldap://localhost',
+            389,
+            'uid=binduser,ou=people,o=test',
+            'bindpwd',
+            'ou=people,o=test',
+        )
+
+        with self.assertRaises(ldap.NO_SUCH_OBJECT):
+            list(m.get_users('(uid=*)', shards=['ou=missing,o=test']))
+
+    def test_shard_search(self):
+        m = database.LDAPDatabase(
+            'ldap://localhost',
+            389,
+            'uid=binduser,ou=people,o=test',
+            'bindpwd',
+            'ou=people,o=test',
+        )
+
+        self.assertEqual(m.shard_search('(uid=a*)', '(uid=*)'),
+            ('ou=people,o=test', '(&(uid=*)(uid=a*))'))
+        self.assertEqual(m.shard_search('ou=dev,ou=people,o=test', '(uid=*)'),
+            ('ou=dev,ou=people,o=test', '(uid=*)'))
+
+    def test_get_users_prefetch(self):
+        m = database.LDAPDatabase(
+            'ldap://localhost',
+            389,
+            'uid=binduser,ou=people,o=test',
+            'bindpwd',
+            'ou=people,o=test',
+        )
+
+        users = {dn: data for dn, data in m.get_users('(uid=*)', prefetch=1)}
+        self.assertEqual(len(users), len([1 for u in test_directory if 'uid=' in u]))
+
+        # The already bound connection is used by the producer thread
+        self.assertEqual(self.ldapobj.methods_called(), ['initialize', 'simple_bind_s', 'search_s'])
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+import pytest
+from mock import patch
+
+from ldap_expire_notify import evaluate
+from ldap_expire_notify.channel import base
+
+
+class TestChannelCls(base.Channel):
+    def new_worker(self):
+        return base.ChannelWorker(self, self.queue)
+
+
+@pytest.fixture(scope='function')
+def channels():
+    return {
+        'hour': TestChannelCls('hour', {'threshold': 3600}),
+        'day': TestChannelCls('day', {'threshold': 86400}),
+    }
+
+
+@pytest.fixture(scope='function')
+def batch():
+    now = datetime.datetime(2019, 6, 10)
+    return now, [
+        ('uid=expired', {}, now - datetime.timedelta(seconds=1)),
+        ('uid=edge', {}, now + datetime.timedelta(hours=1)),
+        ('uid=hours', {}, now + datetime.timedelta(hours=12)),
+        ('uid=days', {}, now + datetime.timedelta(days=2)),
+    ]
+
+
+def _triggered(pairs):
+    return sorted((user[0], cname) for user, cname in pairs)
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_evaluate(channels, batch, use_numpy):
+    if use_numpy and evaluate.numpy is None:
+        pytest.skip('numpy is not installed')
+
+    now, users = batch
+    index = evaluate.ThresholdIndex(channels, now)
+    with patch.object(evaluate, 'numpy', evaluate.numpy if use_numpy else None):
+        pairs = evaluate.evaluate(users, index)
+
+    assert _triggered(pairs) == [
+        ('uid=edge', 'day'),
+        ('uid=expired', 'day'),
+        ('uid=expired', 'hour'),
+        ('uid=hours', 'day'),
+    ]
+    # Same result as checking every channel
+    expected = [
+        (user[0], cname)
+        for user in users
+        for cname, cinfo in channels.items()
+        if user[2] - datetime.timedelta(seconds=cinfo.threshold) < now
+    ]
+    assert _triggered(pairs) == sorted(expected)
+
+
+def test_evaluate_empty(channels):
+    assert evaluate.evaluate([], evaluate.ThresholdIndex(channels)) == []
+
+
+def test_threshold_index(channels):
+    now = datetime.datetime(2019, 6, 10)
+    index = evaluate.ThresholdIndex(channels, now)
+
+    assert index.now == now
+    assert index.thresholds == [3600, 86400]
+    assert [c for c, _ in index.channels] == ['hour', 'day']
+
+    def reached(delta):
+        return [c for c, _ in index.reached(now + delta)]
+
+    assert reached(datetime.timedelta(seconds=-1)) == ['hour', 'day']
+    assert reached(datetime.timedelta(seconds=3599)) == ['hour', 'day']
+    # Thresholds are reached when expiration - threshold < now
+    assert reached(datetime.timedelta(seconds=3600)) == ['day']
+    assert reached(datetime.timedelta(seconds=86399, microseconds=999999)) == ['day']
+    assert reached(datetime.timedelta(seconds=86400)) == []
+
+
+def test_threshold_index_now():
+    was = datetime.datetime.now()
+    index = evaluate.ThresholdIndex({})
+    assert was <= index.now <= datetime.datetime.now()
+    assert index.reached(was) == []
+
+
+def test_threshold_index_next_crossing(channels):
+    now = datetime.datetime(2019, 6, 10)
+    index = evaluate.ThresholdIndex(channels, now)
+    expiration = now + datetime.timedelta(days=2)
+
+    day = index.next_crossing(expiration)
+    assert day == expiration - datetime.timedelta(days=1, microseconds=-1)
+    assert [c for c, _ in index.reached(expiration, day)] == ['day']
+    assert [c for c, _ in index.reached(expiration, day - datetime.timedelta(microseconds=1))] == []
+
+    hour = index.next_crossing(expiration, day)
+    assert hour == expiration - datetime.timedelta(hours=1, microseconds=-1)
+    assert [c for c, _ in index.reached(expiration, hour)] == ['hour', 'day']
+    assert index.next_crossing(expiration, hour) is None
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+import pytest
+
+from ldap_expire_notify import state
+
+
+@pytest.fixture(scope='function')
+def store(tmpdir):
+    store = state.StateStore(str(tmpdir.join('state.db')))
+    yield store
+    store.close()
+
+
+def test_last_sent(store):
+    expiration = datetime.datetime(2019, 6, 10, 15, 53, 21)
+    sent = datetime.datetime(2019, 6, 1, 10, 0, 0, 123)
+
+    assert store.last_sent('uid=test', 'email', expiration) is None
+
+    store.record('uid=test', 'email', expiration, sent)
+    assert store.last_sent('uid=test', 'email', expiration) == sent
+    assert store.last_sent('uid=test', 'webhook', expiration) is None
+    assert store.last_sent('uid=other', 'email', expiration) is None
+    # Password was changed, so expiration time is different
+    assert store.last_sent('uid=test', 'email', expiration + datetime.timedelta(days=1)) is None
+
+    store.record('uid=test', 'email', expiration, sent + datetime.timedelta(days=1))
+    assert store.last_sent('uid=test', 'email', expiration) == sent + datetime.timedelta(days=1)
+
+
+def test_persistence(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    expiration = datetime.datetime(2019, 6, 10, 15, 53, 21)
+
+    store = state.StateStore(path)
+    store.record('uid=test', 'email', expiration)
+    store.close()
+
+    store = state.StateStore(path)
+    assert store.last_sent('uid=test', 'email', expiration) is not None
+    store.close()
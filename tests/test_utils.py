@@ -43,6 +43,21 @@ def test_start_channels(app_channels):
     assert all(isinstance(w, channel.email.EmailWorker) for w in app_channels['email-test'].workers)
 
 
+def test_start_channels_max_threads():
+    with patch('smtplib.SMTP'):
+        app_channels = utils.start_channels('channels/', 'smtp.example.org', None, None,
+            False, False, max_threads=4)
+    try:
+        budget = app_channels['email-test'].budget
+        assert budget is app_channels['webhook-test'].budget
+        assert budget.fair_share() == 2
+        # Configured workers are always started
+        assert budget.used == 20
+    finally:
+        utils.stop_channels(app_channels)
+    assert budget.used == 0
+
+
 def test_stop_channels(app_channels):
     utils.stop_channels(app_channels)
 
@@ -50,6 +65,22 @@ def test_stop_channels(app_channels):
     assert len(app_channels['email-test'].workers) == 0
 
 
+def test_get_channels_attributes(app_channels):
+    attrs = utils.get_channels_attributes(app_channels, 'pwdChangedTime')
+    assert attrs == ['cn', 'mail', 'pwdChangedTime', 'slack']
+
+    app_channels['email-test'].template('{{ ldap }}')
+    assert utils.get_channels_attributes(app_channels, 'pwdChangedTime') is None
+
+
+def test_get_notify_cutoff(app_channels):
+    now = datetime.datetime(2019, 1, 1)
+    max_age = 31536000
+    cutoff = utils.get_notify_cutoff(app_channels, max_age, now)
+    # webhook-test has the biggest threshold
+    assert cutoff == now - datetime.timedelta(seconds=max_age - 2592000000)
+
+
 def test_get_user_expiration_time():
     date_format = '%Y%m%d%H%M%SZ'
     max_age = 31536000
@@ -73,3 +104,38 @@ def test_get_user_expiration_time():
     # Only first attribute should be taken
     parsed = utils.get_user_expiration_time([now.strftime(date_format), '1234567890'], '%Y%m%d%H%M%SZ', max_age)
     assert parsed == (now + datetime.timedelta(seconds=max_age)).replace(microsecond=0)
+
+
+def test_parse_generalized_time():
+    expected = datetime.datetime(2019, 6, 10, 15, 53, 21)
+    assert utils.parse_generalized_time('20190610155321Z') == expected
+    assert utils.parse_generalized_time('20190610155321.5Z') == expected.replace(microsecond=500000)
+    assert utils.parse_generalized_time('20190610155321,1234567Z') == expected.replace(microsecond=123456)
+    assert utils.parse_generalized_time('20190610175321+0200') == expected
+    assert utils.parse_generalized_time('20190610145321-0100') == expected
+
+    for value in ['2019061015532Z', '20190610155321', '20190610155321.Z', '20190610155321+02',
+            '2019061015532aZ', '20191310155321Z']:
+        with pytest.raises(ValueError):
+            utils.parse_generalized_time(value)
+
+
+def test_is_modified_after():
+    cutoff = '20190610155321Z'
+    assert utils.is_modified_after(['20190610155322Z'], cutoff)
+    assert utils.is_modified_after(['20200101000000.123Z'], cutoff)
+    assert not utils.is_modified_after(['20190610155321.999Z'], cutoff)
+    assert not utils.is_modified_after(['20180101000000Z'], cutoff)
+    # Values not in UTC or invalid are never skipped
+    assert not utils.is_modified_after(['20200101000000+0200'], cutoff)
+    assert not utils.is_modified_after(['2020'], cutoff)
+    assert not utils.is_modified_after(None, cutoff)
+    assert not utils.is_modified_after([], cutoff)
+
+
+def test_get_user_expiration_time_custom_format():
+    parsed = utils.get_user_expiration_time(['2019-06-10 15:53:21'], '%Y-%m-%d %H:%M:%S', 10)
+    assert parsed == datetime.datetime(2019, 6, 10, 15, 53, 31)
+
+    with pytest.raises(utils.MissingModify):
+        utils.get_user_expiration_time(['20190610155321Z'], '%Y-%m-%d %H:%M:%S', 10)